@@ -261,7 +261,12 @@ static PyObject* Acquisition_AcquireImages(Acquisition *self)
 {
     TEMScripting::AcqImages* collection;
     
-    HRESULT result = self->iface->raw_AcquireImages(&collection);
+    HRESULT result;
+
+    // Acquisition takes at least the exposure time: Allow other python threads to run meanwhile
+    Py_BEGIN_ALLOW_THREADS
+    result = self->iface->raw_AcquireImages(&collection);
+    Py_END_ALLOW_THREADS
     if (FAILED(result)) {
         raiseComError(result);
         return NULL;
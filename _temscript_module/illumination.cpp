@@ -40,7 +40,12 @@ static PyObject* Illumination_Normalize(Illumination *self, PyObject* args)
     if (!PyArg_ParseTuple(args, "l", &norm))
         return NULL;
 
-    HRESULT result = self->iface->raw_Normalize((TEMScripting::IlluminationNormalization)norm);
+    HRESULT result;
+
+    // Normalization may take seconds: Allow other python threads to run meanwhile
+    Py_BEGIN_ALLOW_THREADS
+    result = self->iface->raw_Normalize((TEMScripting::IlluminationNormalization)norm);
+    Py_END_ALLOW_THREADS
     if (FAILED(result)) {
         raiseComError(result);
         return NULL;
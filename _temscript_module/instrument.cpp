@@ -28,7 +28,12 @@ BOOL_PROPERTY_SETTER(Instrument, AutoNormalizeEnabled)
 
 static PyObject* Instrument_NormalizeAll(Instrument *self)
 {
-    HRESULT result = self->iface->raw_NormalizeAll();
+    HRESULT result;
+
+    // Normalization may take seconds: Allow other python threads to run meanwhile
+    Py_BEGIN_ALLOW_THREADS
+    result = self->iface->raw_NormalizeAll();
+    Py_END_ALLOW_THREADS
     if (FAILED(result)) {
         raiseComError(result);
         return NULL;
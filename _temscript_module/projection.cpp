@@ -72,7 +72,12 @@ static PyObject* Projection_Normalize(Projection *self, PyObject* args)
     if (!PyArg_ParseTuple(args, "l", &norm))
         return NULL;
 
-    HRESULT result = self->iface->raw_Normalize((TEMScripting::ProjectionNormalization)norm);
+    HRESULT result;
+
+    // Normalization may take seconds: Allow other python threads to run meanwhile
+    Py_BEGIN_ALLOW_THREADS
+    result = self->iface->raw_Normalize((TEMScripting::ProjectionNormalization)norm);
+    Py_END_ALLOW_THREADS
     if (FAILED(result)) {
         raiseComError(result);
         return NULL;
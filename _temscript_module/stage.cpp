@@ -194,10 +194,13 @@ static PyObject* Stage_GoTo(Stage *self, PyObject* args, PyObject* kw)
     }
 
     if (axes) {
+        // Stage movement may take seconds: Allow other python threads to run meanwhile
+        Py_BEGIN_ALLOW_THREADS
 		if (speed != 1.0)
 			result = self->iface->raw_GotoWithSpeed(position, (TEMScripting::StageAxes)axes, speed);
 		else
 			result = self->iface->raw_Goto(position, (TEMScripting::StageAxes)axes);
+        Py_END_ALLOW_THREADS
         if (FAILED(result)) {
 		    position->Release();
             raiseComError(result);
@@ -226,7 +229,10 @@ static PyObject* Stage_MoveTo(Stage *self, PyObject* args, PyObject* kw)
     }
 
     if (axes) {
+        // Stage movement may take seconds: Allow other python threads to run meanwhile
+        Py_BEGIN_ALLOW_THREADS
         result = self->iface->raw_MoveTo(position, (TEMScripting::StageAxes)axes);
+        Py_END_ALLOW_THREADS
         if (FAILED(result)) {
 			position->Release();
             raiseComError(result);
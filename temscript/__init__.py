@@ -6,3 +6,4 @@ from .microscope import Microscope
 from .null_microscope import NullMicroscope
 from .remote_microscope import RemoteMicroscope
 
+from .cached_microscope import CachedMicroscope
@@ -0,0 +1,116 @@
+from __future__ import division, print_function
+import struct
+import numpy as np
+
+from .compression import shuffle_bytes, unshuffle_bytes
+
+# Content type of the binary array transport
+NDARRAY_CONTENT_TYPE = "application/x-temscript-ndarray"
+
+# Array types supported by the transport (same set as for the JSON transport)
+NDARRAY_TYPES = ("INT8", "INT16", "INT32", "INT64", "UINT8", "UINT16", "UINT32", "UINT64", "FLOAT32", "FLOAT64")
+
+_MAGIC = b"TSND"
+_VERSION = 1
+_ALIGNMENT = 8
+
+# Message flags: array data is byte shuffled (see compression.shuffle_bytes)
+FLAG_SHUFFLE = 0x01
+
+# Message header: magic, version, flags, number of arrays
+_MESSAGE_HEADER = struct.Struct("<4sBBH")
+# Array header: length of name, type index, endianness (0: little, 1: big), number of dimensions
+_ARRAY_HEADER = struct.Struct("<HBBB")
+
+
+def is_ndarray_dict(obj):
+    """Return whether 'obj' is a non-empty dict of numpy arrays, which can be sent with the binary transport"""
+    if not isinstance(obj, dict) or not obj:
+        return False
+    for value in obj.values():
+        if not isinstance(value, np.ndarray) or value.dtype.name.upper() not in NDARRAY_TYPES:
+            return False
+    return True
+
+
+def encode_ndarrays(arrays, shuffle=False):
+    """
+    Encode dict of numpy arrays for the binary transport.
+
+    The message starts with a fixed header (magic "TSND", version, flags, number of arrays). For each
+    array follows a header (name, type, endianness, shape) and - aligned to 8 bytes - the raw array buffer.
+
+    :param arrays: Dict of numpy arrays indexed by name
+    :param shuffle: Whether the array data is byte shuffled (improves compression of detector images)
+    :returns: List of bytes-like objects, which have to be sent in order. The array data is not copied
+        for C-contiguous arrays (unless shuffled).
+    """
+    chunks = []
+    flags = FLAG_SHUFFLE if shuffle else 0
+    header = [_MESSAGE_HEADER.pack(_MAGIC, _VERSION, flags, len(arrays))]
+    offset = _MESSAGE_HEADER.size
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.dtype.byteorder == '<':
+            endian = 0
+        elif array.dtype.byteorder == '>':
+            endian = 1
+        else:
+            import sys
+            endian = 0 if sys.byteorder == "little" else 1
+        encoded_name = name.encode("utf-8")
+        header.append(_ARRAY_HEADER.pack(len(encoded_name), NDARRAY_TYPES.index(array.dtype.name.upper()),
+                                         endian, array.ndim))
+        header.append(encoded_name)
+        header.append(struct.pack("<%dQ" % array.ndim, *array.shape))
+        offset += _ARRAY_HEADER.size + len(encoded_name) + 8 * array.ndim
+        padding = -offset % _ALIGNMENT
+        header.append(b"\0" * padding)
+        offset += padding + array.nbytes
+        chunks.append(b"".join(header))
+        if shuffle:
+            chunks.append(memoryview(shuffle_bytes(array)))
+        else:
+            chunks.append(memoryview(array.reshape(-1).view(np.uint8)))
+        header = []
+    if header:
+        chunks.append(b"".join(header))
+    return chunks
+
+
+def decode_ndarrays(data):
+    """
+    Decode message of the binary transport into dict of numpy arrays.
+
+    The returned arrays share memory with 'data' (no copies are made), unless the data is byte shuffled.
+
+    :param data: Bytes-like object with the complete message
+    :returns: Dict of numpy arrays
+    """
+    view = memoryview(data)
+    magic, version, flags, count = _MESSAGE_HEADER.unpack_from(view, 0)
+    if magic != _MAGIC:
+        raise ValueError("Invalid array message.")
+    if version != _VERSION:
+        raise ValueError("Unsupported array message version: %d" % version)
+    offset = _MESSAGE_HEADER.size
+    result = {}
+    for n in range(count):
+        name_length, type_index, endian, ndim = _ARRAY_HEADER.unpack_from(view, offset)
+        offset += _ARRAY_HEADER.size
+        name = view[offset:offset + name_length].tobytes().decode("utf-8")
+        offset += name_length
+        shape = struct.unpack_from("<%dQ" % ndim, view, offset)
+        offset += 8 * ndim
+        offset += -offset % _ALIGNMENT
+        if type_index >= len(NDARRAY_TYPES):
+            raise ValueError("Unsupported array type in array message: %d" % type_index)
+        dtype = np.dtype(NDARRAY_TYPES[type_index].lower()).newbyteorder('>' if endian else '<')
+        size = int(np.prod(shape, dtype=np.int64))
+        if flags & FLAG_SHUFFLE:
+            array = unshuffle_bytes(view[offset:offset + size * dtype.itemsize], dtype, size).reshape(shape)
+        else:
+            array = np.frombuffer(view, dtype=dtype, count=size, offset=offset).reshape(shape)
+        offset += array.nbytes
+        result[name] = array
+    return result
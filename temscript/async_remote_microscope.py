@@ -0,0 +1,221 @@
+from __future__ import division, print_function
+import json
+
+import aiohttp
+from aiohttp import WSMsgType
+
+from .array_transport import NDARRAY_CONTENT_TYPE, decode_ndarrays
+from .compression import accept_encoding, decompress
+from .endpoints import ENDPOINTS
+from .remote_microscope import _decode_json_arrays
+
+
+def _encode_content(value):
+    """JSON encode content of PUT requests (numpy arrays/scalars are converted to lists/numbers)"""
+    return json.dumps(value, default=lambda obj: obj.tolist()).encode("utf-8")
+
+
+class AsyncRemoteMicroscope(object):
+    """
+    Asynchronous microscope-like class, which connects to a remote microscope server.
+
+    It provides the same methods as :class:`RemoteMicroscope`, but as coroutines. Requests are sent
+    over a pool of keep-alive connections, so several requests can be in flight concurrently.
+    Additionally :meth:`subscribe` allows to receive the change events published by
+    ``MicroscopeServerWithEvents``.
+
+        >>> async with AsyncRemoteMicroscope(("127.0.0.1", 7351)) as microscope:
+        ...     defocus, images = await asyncio.gather(microscope.get_defocus(), microscope.acquire("CCD"))
+
+    The simple getters and setters are generated from the endpoint registry of the server.
+
+    :param address: (host, port) combination for the remote microscope.
+    :param transport: Underlying transport protocol, either 'JSON' (default) or 'pickle'
+    :param timeout: Timeout of requests in seconds (default: None, no timeout)
+    :param pool_size: Maximum number of concurrent connections (default: 8)
+    """
+    def __init__(self, address, transport=None, timeout=None, pool_size=8):
+        self.address = address
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+        if transport is None:
+            transport = "JSON"
+        if transport == "JSON":
+            self.accepted_content = ["application/json"]
+        elif transport == "PICKLE":
+            self.accepted_content = ["application/python-pickle"]
+        else:
+            raise ValueError("Unknown transport protocol.")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            # Content encoding is handled by _request (aiohttp doesn't support all codecs)
+            self._session = aiohttp.ClientSession(connector=connector, auto_decompress=False,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        """Close all connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _url(self, endpoint, scheme="http"):
+        return "%s://%s:%d%s" % (scheme, self.address[0], self.address[1], endpoint)
+
+    async def _request(self, method, endpoint, query=(), body=None, headers=None, accepted_response=(200,)):
+        headers = dict(headers) if headers is not None else {}
+        if "Accept" not in headers:
+            headers["Accept"] = ",".join(self.accepted_content)
+        if "Accept-Encoding" not in headers:
+            headers["Accept-Encoding"] = accept_encoding()
+        session = self._get_session()
+        async with session.request(method, self._url(endpoint), params=list(query), data=body,
+                                   headers=headers) as response:
+            content = await response.read()
+            if response.status not in accepted_response:
+                raise ValueError("Failed remote call: %d, %s" % (response.status, response.reason))
+            if response.status == 204:
+                return response, content
+            content_type = response.content_type
+            content_encoding = response.headers.get("Content-Encoding")
+
+        # Decode response
+        if content_encoding:
+            content = decompress(content, content_encoding)
+        if content_type not in headers["Accept"].split(","):
+            raise ValueError("Unexpected response type: {}".format(content_type))
+        if content_type == NDARRAY_CONTENT_TYPE:
+            content = decode_ndarrays(content)
+        elif content_type == "application/json":
+            content = json.loads(content.decode("utf-8"))
+        elif content_type == "application/python-pickle":
+            import pickle
+            content = pickle.loads(content)
+        else:
+            raise ValueError("Unsupported response type: %s", content_type)
+        return response, content
+
+    async def _get(self, endpoint, query=()):
+        response, body = await self._request("GET", endpoint, query=query)
+        return body
+
+    async def _put(self, endpoint, value):
+        response, body = await self._request("PUT", endpoint, body=_encode_content(value),
+                                             accepted_response=(200, 204),
+                                             headers={"Content-Type": "application/json"})
+        return body
+
+    async def get_many(self, *names):
+        """
+        Read several properties with one request.
+
+        :param names: Names of the properties (e.g. "defocus", "intensity", "detector_param/CCD")
+        :returns: dict with values indexed by name
+        """
+        return await self._get("/v1/batch", query=[("props", name) for name in names])
+
+    async def set_many(self, operations):
+        """
+        Set several properties with one request (see :meth:`RemoteMicroscope.set_many`).
+
+        :param operations: List of (name, value) pairs or dict with values indexed by name
+        :returns: List with a result dict for each operation
+        """
+        if isinstance(operations, dict):
+            operations = operations.items()
+        return await self._put("/v1/batch", [(name, value) for name, value in operations])
+
+    async def set_stage_position(self, pos=None, method=None, **kw):
+        pos = dict(pos, **kw) if pos is not None else dict(**kw)
+        if method is not None:
+            pos["method"] = method
+        elif "method" in pos:
+            del pos["method"]
+        await self._put("/v1/stage_position", pos)
+
+    async def get_detector_param(self, name):
+        return await self._get("/v1/detector_param/" + name)
+
+    async def set_detector_param(self, name, param):
+        await self._put("/v1/detector_param/" + name, param)
+
+    async def get_optics_state(self, fields=None):
+        query = [("fields", field) for field in fields] if fields is not None else ()
+        return await self._get("/v1/optics_state", query=query)
+
+    async def acquire(self, *detectors):
+        query = [("detectors", det) for det in detectors]
+        # Prefer binary array transport, servers not supporting it fall back to the regular transport
+        accept = ",".join([NDARRAY_CONTENT_TYPE] + self.accepted_content)
+        response, body = await self._request("GET", "/v1/acquire", query=query, headers={"Accept": accept})
+        if response.content_type == "application/json":
+            body = _decode_json_arrays(body)
+        return body
+
+    async def normalize(self, mode="ALL"):
+        await self._put("/v1/normalize", str(mode))
+
+    async def subscribe(self, since=None, props=None):
+        """
+        Asynchronous iterator over the change events published by ``MicroscopeServerWithEvents``.
+
+        Each event is a dict with the changed values indexed by property name. The first event
+        contains the complete state known to the server.
+
+            >>> async for changes in microscope.subscribe():
+            ...     print(changes)
+
+        If `since` is given, the sequenced protocol is used: The messages are yielded as sent by the
+        server, i.e. dicts with the keys "seq", "timestamp" and "changes" (or "snapshot" for the
+        complete state). The server resends the events after sequence number `since`, if they are
+        still in its history, otherwise it starts with a snapshot (use 0 to always start with a snapshot).
+
+        :param since: Sequence number of the last event received (default: None, legacy protocol)
+        :param props: Names of the properties to receive changes for (default: None, all properties)
+        """
+        session = self._get_session()
+        query = []
+        if since is not None:
+            query.append(("since", str(int(since))))
+        if props is not None:
+            query.extend(("props", prop) for prop in props)
+        async with session.ws_connect(self._url("/ws/v1", scheme="ws"), params=query) as ws:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    yield json.loads(msg.data)
+                elif msg.type in (WSMsgType.CLOSED, WSMsgType.ERROR):
+                    break
+
+
+def _make_getter(endpoint):
+    async def getter(self):
+        return await self._get("/v1/" + endpoint)
+    getter.__name__ = "get_" + endpoint
+    return getter
+
+
+def _make_setter(endpoint):
+    async def setter(self, value):
+        await self._put("/v1/" + endpoint, value)
+    setter.__name__ = "set_" + endpoint
+    return setter
+
+
+# Add the simple getters and setters of all registered endpoints
+for _entry in ENDPOINTS.values():
+    if _entry.has_path:
+        continue
+    if _entry.getter == "get_" + _entry.name and not hasattr(AsyncRemoteMicroscope, _entry.getter):
+        setattr(AsyncRemoteMicroscope, _entry.getter, _make_getter(_entry.name))
+    if _entry.setter == "set_" + _entry.name and not hasattr(AsyncRemoteMicroscope, _entry.setter):
+        setattr(AsyncRemoteMicroscope, _entry.setter, _make_setter(_entry.name))
+del _entry
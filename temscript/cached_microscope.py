@@ -0,0 +1,149 @@
+from __future__ import division, print_function
+import threading
+import time
+
+
+class CachedMicroscope(object):
+    """
+    Microscope-like class, which caches the results of the getters of another microscope.
+
+    Static properties (see :attr:`STATIC_PROPERTIES`) are cached forever, all other properties for
+    their time-to-live. Calling a setter invalidates the cached values of the property itself and of
+    all properties depending on it (see :attr:`DEPENDENCIES`). Calling :meth:`normalize` invalidates all
+    non-static properties.
+
+    The cached values are returned as is, so they should not be modified by the caller.
+
+        >>> microscope = CachedMicroscope(Microscope(), ttl={"vacuum": 1.0})
+        >>> microscope.get_family()
+        "TITAN"
+
+    :param microscope: Microscope to cache
+    :param ttl: Time-to-live in seconds indexed by property name (name of the getter without "get_").
+        A TTL of None caches the value forever.
+    :type ttl: dict
+    :param default_ttl: Time-to-live in seconds for properties not in `ttl` (default: 0.0, no caching)
+    :type default_ttl: float
+    """
+    STATIC_PROPERTIES = frozenset(("family", "microscope_id", "version", "stage_limits", "detectors",
+                                   "voltage_offset_range"))
+
+    # Properties, which are never cached
+    UNCACHED_PROPERTIES = frozenset(("frame_stream",))
+
+    # Properties, which change when the property used as key is set
+    DEPENDENCIES = {
+        "projection_mode": ("projection_mode_type_string", "projection_sub_mode", "projection_mode_string",
+                            "magnification_index", "indicated_magnification", "indicated_camera_length"),
+        "magnification_index": ("projection_sub_mode", "projection_mode_string", "indicated_magnification",
+                                "indicated_camera_length"),
+        "lens_program": ("lens_program_string",),
+        "df_mode": ("df_mode_string", "beam_tilt"),
+        "beam_tilt": ("df_mode", "df_mode_string"),
+        "stage_position": ("stage_status",),
+        "defocus": ("objective_excitation",),
+        "intensity": ("illuminated_area", "convergence_angle"),
+        "illuminated_area": ("intensity", "convergence_angle"),
+        "voltage_offset": ("voltage",),
+    }
+
+    def __init__(self, microscope, ttl=None, default_ttl=0.0):
+        self._microscope = microscope
+        self._ttl = dict((name, None) for name in self.STATIC_PROPERTIES)
+        if ttl is not None:
+            self._ttl.update(ttl)
+        self._default_ttl = default_ttl
+        self._cache = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._microscope, name)
+        if not callable(attr):
+            return attr
+        if name.startswith("get_"):
+            prop = name[4:]
+            ttl = self._ttl.get(prop, self._default_ttl)
+            if prop not in self.UNCACHED_PROPERTIES and (ttl is None or ttl > 0):
+                return self._cached_getter(prop, attr, ttl)
+        elif name.startswith("set_"):
+            return self._invalidating_setter(name[4:], attr)
+        elif name == "normalize":
+            return self._invalidating_setter(None, attr)
+        return attr
+
+    def _cached_getter(self, prop, getter, ttl):
+        def get(*args, **kw):
+            try:
+                key = (prop, args, tuple(sorted(kw.items())))
+                hash(key)
+            except TypeError:
+                # Unhashable arguments: bypass cache
+                return getter(*args, **kw)
+            now = time.time()
+            with self._lock:
+                try:
+                    expires, value = self._cache[key]
+                except KeyError:
+                    pass
+                else:
+                    if expires is None or expires > now:
+                        self._hits += 1
+                        return value
+                self._misses += 1
+                generation = self._generation
+            value = getter(*args, **kw)
+            with self._lock:
+                # Don't store value, if cache was invalidated during the call
+                if generation == self._generation:
+                    self._cache[key] = (now + ttl if ttl is not None else None, value)
+            return value
+        return get
+
+    def _invalidating_setter(self, prop, setter):
+        def call(*args, **kw):
+            try:
+                return setter(*args, **kw)
+            finally:
+                self.invalidate(prop)
+        return call
+
+    def invalidate(self, prop=None):
+        """
+        Invalidate cached values depending on property `prop`.
+
+        :param prop: Name of the changed property. If None, all non-static properties are invalidated.
+        """
+        if prop is None:
+            with self._lock:
+                self._generation += 1
+                for key in list(self._cache.keys()):
+                    if key[0] not in self.STATIC_PROPERTIES:
+                        del self._cache[key]
+            return
+        props = set(self.DEPENDENCIES.get(prop, ()))
+        props.update((prop, prop + "_string", "optics_state"))
+        with self._lock:
+            self._generation += 1
+            for key in list(self._cache.keys()):
+                if key[0] in props:
+                    del self._cache[key]
+
+    def clear_cache(self):
+        """Remove all values (including static ones) from cache."""
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def get_cache_stats(self):
+        """
+        Return cache statistics as dict with the keys "hits", "misses", and "size" (number of cached values).
+        """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "size": len(self._cache),
+            }
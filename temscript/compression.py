@@ -0,0 +1,156 @@
+from __future__ import division, print_function
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Accept-Encoding token for byte shuffling of arrays in the binary array transport
+SHUFFLE_TOKEN = "x-shuffle"
+
+# Responses smaller than this are not compressed
+MIN_COMPRESS_SIZE = 256
+
+# Responses of at least this size (or of unknown size) are compressed with the fastest available codec,
+# smaller responses with the codec giving the best compression.
+LARGE_RESPONSE_SIZE = 64 * 1024
+
+# Codec preference (by content coding) for small and large responses
+_SMALL_PREFERENCE = ("zstd", "gzip", "lz4")
+_LARGE_PREFERENCE = ("lz4", "zstd", "gzip")
+
+
+class _LZ4Compressor(object):
+    """Wrap lz4.frame.LZ4FrameCompressor into the compress/flush interface of zlib"""
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._started = False
+
+    def _begin(self):
+        if self._started:
+            return b""
+        self._started = True
+        return self._compressor.begin()
+
+    def compress(self, data):
+        return self._begin() + self._compressor.compress(data)
+
+    def flush(self):
+        return self._begin() + self._compressor.flush()
+
+
+def _gzip_compressobj(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def _zstd_compressobj(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _zstd_decompress(data):
+    # Streamed frames don't contain the content size, so the streaming decompressor is used
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def _lz4_compressobj(level):
+    # LZ4 is used for its speed, the level is ignored
+    return _LZ4Compressor()
+
+
+# Available codecs: content coding -> (compressobj factory, decompress function)
+CODECS = {"gzip": (_gzip_compressobj, _gzip_decompress)}
+if zstandard is not None:
+    CODECS["zstd"] = (_zstd_compressobj, _zstd_decompress)
+if lz4 is not None:
+    CODECS["lz4"] = (_lz4_compressobj, lz4.frame.decompress)
+
+
+def parse_accept_encoding(header):
+    """Return list of content codings in Accept-Encoding header (without quality values)"""
+    return [x.split(';', 1)[0].strip() for x in header.split(",")]
+
+
+def accept_encoding():
+    """Value of the Accept-Encoding header for clients (all available codecs and byte shuffling)"""
+    return ", ".join([name for name in _SMALL_PREFERENCE if name in CODECS] + [SHUFFLE_TOKEN])
+
+
+def choose_codec(accepted, size=None):
+    """
+    Choose codec for a response.
+
+    :param accepted: List of content codings accepted by the client
+    :param size: Size of the (uncompressed) response in bytes or None if unknown
+    :returns: Content coding or None for no compression
+    """
+    if size is not None and size < MIN_COMPRESS_SIZE:
+        return None
+    preference = _LARGE_PREFERENCE if size is None or size >= LARGE_RESPONSE_SIZE else _SMALL_PREFERENCE
+    for name in preference:
+        if name in CODECS and name in accepted:
+            return name
+    return None
+
+
+def compressobj(codec, level=5):
+    """
+    Create compressor for `codec`.
+
+    :param codec: Content coding
+    :param level: Compression level (used as zlib level for gzip and as zstd level, ignored for lz4)
+    :returns: Object with compress(data) and flush() methods
+    """
+    return CODECS[codec][0](level)
+
+
+def decompress(data, codec):
+    """
+    Decompress `data` encoded with `codec`.
+
+    :raises ValueError: If the codec is not available
+    """
+    if codec == "identity":
+        return data
+    try:
+        decompress_func = CODECS[codec][1]
+    except KeyError:
+        raise ValueError("Unsupported content encoding: %s" % codec)
+    return decompress_func(data)
+
+
+def shuffle_bytes(array):
+    """
+    Reorder bytes of a C-contiguous array, such that the n-th bytes of all elements are stored
+    consecutively. For detector images this puts the (mostly constant) high bytes together, which
+    improves compression.
+
+    :returns: 1D uint8 array
+    """
+    data = array.reshape(-1).view(np.uint8)
+    return np.ascontiguousarray(data.reshape(-1, array.itemsize).T).reshape(-1)
+
+
+def unshuffle_bytes(data, dtype, count):
+    """
+    Revert :func:`shuffle_bytes`.
+
+    :param data: Bytes-like object with the shuffled data
+    :param dtype: Type of the array elements
+    :param count: Number of array elements
+    :returns: 1D array of type `dtype`
+    """
+    dtype = np.dtype(dtype)
+    planes = np.frombuffer(data, dtype=np.uint8, count=count * dtype.itemsize).reshape(dtype.itemsize, count)
+    return np.ascontiguousarray(planes.T).view(dtype).reshape(-1)
@@ -0,0 +1,311 @@
+from __future__ import division, print_function
+
+from .microscope import STAGE_AXES, _string_types
+
+
+class EndpointError(Exception):
+    """Raised if a request can not be mapped to a microscope call (reported as HTTP status 404)"""
+    pass
+
+
+def _no_args(path, query):
+    return ()
+
+
+def _content_arg(path, content):
+    return (content,)
+
+
+def _path_arg(path, query):
+    return (path,)
+
+
+def _path_content_args(path, content):
+    return (path, content)
+
+
+def _acquire_args(path, query):
+    try:
+        return tuple(query["detectors"])
+    except (KeyError, TypeError):
+        raise EndpointError("No detectors")
+
+
+def _optics_state_args(path, query):
+    # Optional field selection
+    if query and "fields" in query:
+        return (tuple(query["fields"]),)
+    return ()
+
+
+def _stage_position_args(path, content):
+    method = content.get("method", "GO")
+    pos = dict((k, content[k]) for k in content.keys() if k in STAGE_AXES)
+    try:
+        pos['speed'] = content['speed']
+    except KeyError:
+        pass
+    return pos, method
+
+
+class Endpoint(object):
+    """
+    Description of a V1 endpoint of the microscope server.
+
+    :param name: Name of the endpoint (path component after "/v1/")
+    :param getter: Name of the microscope method called for GET requests (None: no GET requests)
+    :param setter: Name of the microscope method called for PUT requests (None: no PUT requests)
+    :param get_args: Callable (path, query) returning the positional arguments of the getter
+    :param set_args: Callable (path, content) returning the positional arguments of the setter
+    :param has_path: Whether the endpoint expects a further path component (e.g. "detector_param/CCD")
+    :param not_found: Exception types raised by the microscope method, which are reported as EndpointError
+    :param batch: Whether the endpoint can be part of a batch request
+
+    Instead of method names, getter and setter can also be callables, which are called with the microscope
+    as first argument.
+    """
+    __slots__ = ("name", "getter", "setter", "get_args", "set_args", "has_path", "not_found", "batch")
+
+    def __init__(self, name, getter=None, setter=None, get_args=_no_args, set_args=_content_arg,
+                 has_path=False, not_found=(), batch=True):
+        self.name = name
+        self.getter = getter
+        self.setter = setter
+        self.get_args = get_args
+        self.set_args = set_args
+        self.has_path = has_path
+        self.not_found = not_found
+        self.batch = batch
+
+
+# Endpoint registry, indexed by name
+ENDPOINTS = {}
+
+
+def _register(name, getter=None, setter=None, **kw):
+    ENDPOINTS[name] = Endpoint(name, getter, setter, **kw)
+
+
+_register("family", "get_family")
+_register("microscope_id", "get_microscope_id")
+_register("version", "get_version")
+_register("voltage", "get_voltage")
+_register("voltage_offset", "get_voltage_offset", "set_voltage_offset")
+_register("vacuum", "get_vacuum")
+_register("stage_holder", "get_stage_holder")
+_register("stage_status", "get_stage_status")
+_register("stage_position", "get_stage_position", "set_stage_position", set_args=_stage_position_args)
+_register("stage_limits", "get_stage_limits")
+_register("detectors", "get_detectors")
+_register("image_shift", "get_image_shift", "set_image_shift")
+_register("beam_shift", "get_beam_shift", "set_beam_shift")
+_register("beam_tilt", "get_beam_tilt", "set_beam_tilt")
+_register("instrument_mode", "get_instrument_mode")
+_register("instrument_mode_string", "get_instrument_mode_string")
+_register("df_mode", "get_df_mode", "set_df_mode")
+_register("df_mode_string", "get_df_mode_string")
+_register("projection_sub_mode", "get_projection_sub_mode")
+_register("projection_mode", "get_projection_mode", "set_projection_mode")
+_register("projection_mode_string", "get_projection_mode_string")
+_register("projection_mode_type_string", "get_projection_mode_type_string")
+_register("lens_program", "get_lens_program", "set_lens_program")
+_register("lens_program_string", "get_lens_program_string")
+_register("illumination_mode", "get_illumination_mode")
+_register("illumination_mode_string", "get_illumination_mode_string")
+_register("illuminated_area", "get_illuminated_area", "set_illuminated_area")
+_register("convergence_angle", "get_convergence_angle")
+_register("condenser_mode", "get_condenser_mode")
+_register("condenser_mode_string", "get_condenser_mode_string")
+_register("spot_size_index", "get_spot_size_index")
+_register("magnification_index", "get_magnification_index", "set_magnification_index")
+_register("stem_magnification", "get_stem_magnification", "set_stem_magnification")
+_register("indicated_camera_length", "get_indicated_camera_length")
+_register("indicated_magnification", "get_indicated_magnification")
+_register("defocus", "get_defocus", "set_defocus")
+_register("probe_defocus", "get_probe_defocus", "set_probe_defocus")
+_register("objective_excitation", "get_objective_excitation")
+_register("intensity", "get_intensity", "set_intensity")
+_register("objective_stigmator", "get_objective_stigmator", "set_objective_stigmator")
+_register("condenser_stigmator", "get_condenser_stigmator", "set_condenser_stigmator")
+_register("diffraction_shift", "get_diffraction_shift", "set_diffraction_shift")
+_register("optics_state", "get_optics_state", get_args=_optics_state_args, not_found=(ValueError,))
+_register("beam_blanked", "get_beam_blanked", "set_beam_blanked")
+_register("detector_param", "get_detector_param", "set_detector_param", get_args=_path_arg,
+          set_args=_path_content_args, has_path=True, not_found=(KeyError,))
+_register("acquire", "acquire", get_args=_acquire_args, batch=False)
+_register("cache_stats", "get_cache_stats", not_found=(AttributeError,))
+_register("normalize", setter="normalize", not_found=(ValueError,))
+
+
+def find_endpoint(endpoint):
+    """
+    Look up endpoint.
+
+    :param endpoint: Endpoint path (without "/v1/" prefix), e.g. "defocus" or "detector_param/CCD"
+    :returns: Tuple (Endpoint, remaining path)
+    :raises EndpointError: If the endpoint is unknown
+    """
+    name, sep, path = endpoint.partition("/")
+    entry = ENDPOINTS.get(name)
+    if entry is None or bool(sep) != entry.has_path:
+        raise EndpointError("Unknown endpoint: %s" % endpoint)
+    return entry, path
+
+
+def get_value(microscope, endpoint, query=None):
+    """
+    Execute GET request for `endpoint` on `microscope`.
+
+    :param microscope: Microscope instance
+    :param endpoint: Endpoint path (without "/v1/" prefix)
+    :param query: dict with query parameters (lists of values indexed by name)
+    :returns: Result of the microscope call
+    :raises EndpointError: If the request can not be mapped to a microscope call
+    """
+    entry, path = find_endpoint(endpoint)
+    if entry.getter is None:
+        raise EndpointError("Unknown endpoint: %s" % endpoint)
+    args = entry.get_args(path, query)
+    try:
+        return _call(microscope, entry.getter, args)
+    except entry.not_found as exc:
+        raise EndpointError("Invalid request for endpoint %s: %s" % (endpoint, exc))
+
+
+def set_value(microscope, endpoint, content):
+    """
+    Execute PUT request for `endpoint` on `microscope`.
+
+    :param microscope: Microscope instance
+    :param endpoint: Endpoint path (without "/v1/" prefix)
+    :param content: Decoded JSON content of the request
+    :returns: Result of the microscope call
+    :raises EndpointError: If the request can not be mapped to a microscope call
+    """
+    entry, path = find_endpoint(endpoint)
+    if entry.setter is None:
+        raise EndpointError("Unknown endpoint: %s" % endpoint)
+    args = entry.set_args(path, content)
+    try:
+        return _call(microscope, entry.setter, args)
+    except entry.not_found as exc:
+        raise EndpointError("Invalid request for endpoint %s: %s" % (endpoint, exc))
+
+
+def get_values(microscope, endpoints):
+    """
+    Execute GET requests for several endpoints in one pass.
+
+    All endpoints are looked up before the first microscope call is made. Endpoints, which need
+    query parameters (like "acquire"), can not be part of a batch.
+
+    :param microscope: Microscope instance
+    :param endpoints: List of endpoint paths (without "/v1/" prefix)
+    :returns: dict with results indexed by endpoint path
+    :raises EndpointError: If one of the endpoints is unknown
+    """
+    if (isinstance(endpoints, _string_types) or
+            not all(isinstance(endpoint, _string_types) for endpoint in endpoints)):
+        raise EndpointError("Batch requires list of endpoints")
+    for endpoint in endpoints:
+        entry, path = find_endpoint(endpoint)
+        if entry.getter is None or not entry.batch:
+            raise EndpointError("Endpoint not allowed in batch: %s" % endpoint)
+    result = {}
+    for endpoint in endpoints:
+        result[endpoint] = get_value(microscope, endpoint)
+    return result
+
+
+def set_values(microscope, operations):
+    """
+    Execute PUT requests for several endpoints in one pass.
+
+    The operations are applied in the given order. The batch is atomic: If an operation fails, the remaining
+    operations are skipped and the already applied operations are rolled back in reverse order (by setting the
+    values read before each operation). Operations without getter (like "normalize") can't be rolled back.
+    All endpoints are looked up before the first microscope call is made.
+
+    :param microscope: Microscope instance
+    :param operations: List of (endpoint path, content) pairs
+    :returns: List with a result dict for each operation. The dicts have the keys "endpoint" and "success",
+        failed operations additionally have the key "error", skipped operations the key "skipped", and
+        rolled back operations the key "rolled_back". If the rollback of an operation fails, it keeps
+        "success" and has the key "rollback_error".
+    :raises EndpointError: If one of the endpoints is unknown
+    """
+    try:
+        operations = [(endpoint, content) for endpoint, content in operations]
+    except (TypeError, ValueError):
+        raise EndpointError("Batch requires list of (endpoint, value) pairs")
+    for endpoint, content in operations:
+        if not isinstance(endpoint, _string_types):
+            raise EndpointError("Batch requires list of (endpoint, value) pairs")
+        entry, path = find_endpoint(endpoint)
+        if entry.setter is None or not entry.batch:
+            raise EndpointError("Endpoint not allowed in batch: %s" % endpoint)
+    result = []
+    applied = []    # (index in result, endpoint, previous value) of the applied operations
+    failed = False
+    for endpoint, content in operations:
+        if failed:
+            result.append({"endpoint": endpoint, "success": False, "skipped": True})
+            continue
+        entry, path = find_endpoint(endpoint)
+        try:
+            previous = get_value(microscope, endpoint) if entry.getter is not None else None
+            set_value(microscope, endpoint, content)
+        except Exception as exc:
+            failed = True
+            result.append({"endpoint": endpoint, "success": False, "error": str(exc)})
+            _rollback(microscope, applied, result)
+        else:
+            if entry.getter is not None:
+                applied.append((len(result), endpoint, previous))
+            result.append({"endpoint": endpoint, "success": True})
+    return result
+
+
+def _rollback(microscope, applied, result):
+    """Restore previous values of applied batch operations (in reverse order) and update their results"""
+    for index, endpoint, previous in reversed(applied):
+        try:
+            set_value(microscope, endpoint, previous)
+        except Exception as exc:
+            result[index]["rollback_error"] = str(exc)
+        else:
+            result[index] = {"endpoint": endpoint, "success": False, "rolled_back": True}
+
+
+def _batch_get_args(path, query):
+    try:
+        return (query["props"],)
+    except (KeyError, TypeError):
+        raise EndpointError("No props")
+
+
+def _set_stream(microscope, content):
+    """Start (content: dict with "detectors" and optionally "n_frames", "buffer_size") or stop (content: null)
+    continuous acquisition"""
+    if content is None:
+        microscope.stop_stream()
+        return
+    try:
+        detectors = content["detectors"]
+        n_frames = content.get("n_frames")
+        buffer_size = int(content.get("buffer_size", 8))
+    except (KeyError, TypeError, AttributeError, ValueError):
+        raise EndpointError("Invalid stream request")
+    if isinstance(detectors, _string_types):
+        detectors = [detectors]
+    microscope.start_stream(*detectors, n_frames=n_frames, buffer_size=buffer_size)
+
+
+def _call(microscope, method, args):
+    if callable(method):
+        return method(microscope, *args)
+    return getattr(microscope, method)(*args)
+
+
+_register("batch", get_values, set_values, get_args=_batch_get_args, batch=False)
+_register("stream", setter=_set_stream, not_found=(ValueError,), batch=False)
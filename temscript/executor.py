@@ -0,0 +1,112 @@
+from __future__ import division, print_function
+import threading
+
+# Get imports from library
+try:
+    # Python 3.X
+    import queue
+except ImportError:
+    # Python 2.X
+    import Queue as queue
+
+try:
+    # Python 3.X (or the "futures" backport on Python 2.X)
+    from concurrent.futures import Future
+except ImportError:
+    Future = None
+
+
+class MicroscopeExecutor(object):
+    """
+    Executes calls on a single dedicated worker thread.
+
+    All calls submitted to one executor are serialized in submission order. This is used to keep the
+    (COM-bound) microscope calls off the request handling threads, while requests are handled concurrently.
+
+    Requires :mod:`concurrent.futures` (Python 3, or the "futures" backport on Python 2).
+
+    :param name: Name of the worker thread
+    :type name: str
+    """
+    def __init__(self, name="MicroscopeExecutor"):
+        if Future is None:
+            raise RuntimeError("MicroscopeExecutor requires concurrent.futures (Python 3).")
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, *args, **kw):
+        """
+        Schedule call of `func` with the given arguments on the worker thread.
+
+        :returns: :class:`concurrent.futures.Future` of the call
+        """
+        future = Future()
+        self._queue.put((future, func, args, kw))
+        return future
+
+    def call(self, func, *args, **kw):
+        """Call `func` with the given arguments on the worker thread and wait for the result."""
+        return self.submit(func, *args, **kw).result()
+
+    @property
+    def queue_depth(self):
+        """Number of calls waiting for execution"""
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        """Stop worker thread after all pending calls have been executed."""
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, args, kw = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kw)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+
+class MicroscopeProxy(object):
+    """
+    Microscope-like class, which forwards all method calls to a microscope on executor threads.
+
+    Long running calls (see :attr:`SLOW_METHODS`) are executed on `slow_executor`, if given. This way
+    cheap reads are not queued behind acquisitions. The slow calls release the GIL while the
+    instrument is busy, so both executors run concurrently. The acquisitions of a stream started with
+    :meth:`start_stream` run on `slow_executor` as well, so they are serialized with the other slow calls.
+
+    :param microscope: Microscope to forward calls to
+    :param executor: Executor for all calls
+    :type executor: MicroscopeExecutor
+    :param slow_executor: Optional executor for long running calls
+    :type slow_executor: MicroscopeExecutor
+    """
+    SLOW_METHODS = frozenset(("acquire", "normalize", "set_stage_position", "start_stream", "stop_stream"))
+
+    def __init__(self, microscope, executor, slow_executor=None):
+        self._microscope = microscope
+        self._executor = executor
+        self._slow_executor = slow_executor if slow_executor is not None else executor
+
+    def __getattr__(self, name):
+        attr = getattr(self._microscope, name)
+        if not callable(attr):
+            return attr
+        executor = self._slow_executor if name in self.SLOW_METHODS else self._executor
+
+        def call(*args, **kw):
+            if name == "start_stream":
+                kw.setdefault("executor", self._slow_executor)
+            return executor.call(attr, *args, **kw)
+        return call
@@ -10,6 +10,13 @@ except ImportError:
     # Python 2.X
     from urllib import quote
 
+try:
+    # Python 2.X (JSON strings are decoded as unicode)
+    _string_types = (str, unicode)
+except NameError:
+    # Python 3.X
+    _string_types = (str,)
+
 
 def _parse_enum(type, item):
     """Try to parse 'item' (string or integer) to enum 'type'"""
@@ -22,6 +29,56 @@ def _parse_enum(type, item):
 # Allowed stage axes
 STAGE_AXES = frozenset(('x', 'y', 'z', 'a', 'b'))
 
+# Fields of the optics state (see Microscope.get_optics_state)
+OPTICS_STATE_FIELDS = ("family", "microscope_id", "temscript_version", "voltage(kV)", "stage_holder",
+                       "stage_position", "image_shift", "beam_shift", "beam_tilt", "projection_sub_mode",
+                       "projection_mode", "projection_mode_string", "magnification_index", "indicated_camera_length",
+                       "indicated_magnification", "defocus", "objective_excitation", "intensity",
+                       "condenser_stigmator", "objective_stigmator", "diffraction_shift")
+
+# Fields of the optics state, which never change
+STATIC_OPTICS_STATE_FIELDS = frozenset(("family", "microscope_id", "temscript_version"))
+
+
+def _read_optics_state(microscope, getters, fields, static_state):
+    """
+    Read optics state snapshot.
+
+    :param microscope: Microscope instance
+    :param getters: Dict with getter (method name or callable with microscope as argument) indexed by field name.
+        Fields with the same getter are read only once.
+    :param fields: Names of fields to read (None: all fields)
+    :param static_state: Dict for caching the static fields
+    :raises ValueError: If a field is unknown
+    """
+    if fields is None:
+        fields = OPTICS_STATE_FIELDS
+    elif isinstance(fields, _string_types):
+        fields = (fields,)
+    for field in fields:
+        if field not in getters:
+            raise ValueError("Unknown optics state field: %s" % field)
+
+    state = {}
+    values = {}
+    for field in fields:
+        if field in static_state:
+            state[field] = static_state[field]
+            continue
+        getter = getters[field]
+        try:
+            value = values[getter]
+        except KeyError:
+            if callable(getter):
+                value = getter(microscope)
+            else:
+                value = getattr(microscope, getter)()
+            values[getter] = value
+        if field in STATIC_OPTICS_STATE_FIELDS:
+            static_state[field] = value
+        state[field] = value
+    return state
+
 
 class Microscope(object):
     """
@@ -47,6 +104,10 @@ class Microscope(object):
         self._tem_acquisition = tem.Acquisition
         self._tem_vacuum = tem.Vacuum
         self._family = tem.Configuration.ProductFamily
+        self._stream = None
+        self._acq_devices = None
+        self._detector_index = None
+        self._static_optics_state = {}
 
     def get_family(self):
         """Return product family (see :class:`ProductFamily`): "TITAN", "TECNAI", ..."""
@@ -234,10 +295,12 @@ class Microscope(object):
                 * "binnings": List of supported binnings
         """
         detectors = {}
+        index = {}
         for cam in self._tem_acquisition.Cameras:
             info = cam.Info
             param = cam.AcqParams
             name = quote(info.Name)
+            index[name] = cam
             detectors[name] = {
                 "type": "CAMERA",
                 "height": info.Height,
@@ -250,21 +313,40 @@ class Microscope(object):
             }
         for stem in self._tem_acquisition.Detectors:
             info = stem.Info
+            name = quote(info.Name)
+            index[name] = stem
             detectors[name] = {
                 "type": "STEM_DETECTOR",
                 "binnings": [int(b) for b in info.Binnings],
             }
+        self._detector_index = index
         return detectors
 
-    def _find_detector(self, name):
-        """Find detector object by name"""
+    def refresh_detectors(self):
+        """
+        Rebuild the index of detector objects by name, which is used by :meth:`get_detector_param` and
+        :meth:`set_detector_param`. The index is also rebuilt by :meth:`get_detectors` and if a detector is not found.
+        """
+        index = {}
         for cam in self._tem_acquisition.Cameras:
-            if quote(cam.Info.Name) == name:
-                return cam
+            index[quote(cam.Info.Name)] = cam
         for stem in self._tem_acquisition.Detectors:
-            if quote(stem.Info.Name) == name:
-                return stem
-        raise KeyError("No detector with name %s" % name)
+            index[quote(stem.Info.Name)] = stem
+        self._detector_index = index
+
+    def _find_detector(self, name):
+        """Find detector object by name"""
+        if self._detector_index is not None:
+            try:
+                return self._detector_index[name]
+            except KeyError:
+                pass
+        # Detector enumeration might have changed
+        self.refresh_detectors()
+        try:
+            return self._detector_index[name]
+        except KeyError:
+            raise KeyError("No detector with name %s" % name)
 
     def _get_camera_param(self, det):
         """Create dict with camera parameters"""
@@ -409,12 +491,45 @@ class Microscope(object):
         Acquire images for all detectors given as argument.
         The images are returned in an dict indexed by detector name.
         """
+        if self._stream is not None and self._stream.running:
+            raise RuntimeError("Acquisition stream is running.")
+        self._set_acq_devices(args)
+        try:
+            return self._acquire_images()
+        except Exception:
+            self.reset_acquisition()
+            raise
+
+    def _set_acq_devices(self, detectors):
+        # Only reconfigure the acquisition devices, if the detectors changed. Duplicates are dropped,
+        # but the order of the arguments is kept.
+        devices = []
+        for det in detectors:
+            if det not in devices:
+                devices.append(det)
+        devices = tuple(devices)
+        if devices == self._acq_devices:
+            return
+        self._acq_devices = None
         self._tem_acquisition.RemoveAllAcqDevices()
-        for det in args:
+        complete = True
+        for det in devices:
             try:
                 self._tem_acquisition.AddAcqDeviceByName(det)
             except Exception:
-                pass
+                complete = False
+        # Remember the configuration only if all devices were added, so failed ones are retried
+        if complete:
+            self._acq_devices = devices
+
+    def reset_acquisition(self):
+        """
+        Forget the configured set of acquisition devices, so they are reconfigured by the next call of
+        :meth:`acquire`. Use this, if the acquisition devices were changed by other software.
+        """
+        self._acq_devices = None
+
+    def _acquire_images(self):
         # Read as dict of numpy arrays
         images = self._tem_acquisition.AcquireImages()
         result = {}
@@ -422,6 +537,43 @@ class Microscope(object):
             result[quote(img.Name)] = img.Array
         return result
 
+    def start_stream(self, *detectors, **kw):
+        """
+        Start continuous acquisition of images for all detectors given as argument.
+
+        The detectors are configured once, then frames are acquired back-to-back on a background thread
+        into a ring buffer (see :class:`temscript.stream.FrameStream`). A running stream is stopped first.
+        While the stream is running, :meth:`acquire` can't be used.
+
+        :param n_frames: Number of frames to acquire (default: None, until :meth:`stop_stream` is called)
+        :type n_frames: int
+        :param buffer_size: Number of frames kept in the ring buffer (default: 8)
+        :type buffer_size: int
+        :param executor: Executor the acquisitions are run on (default: None, the stream thread)
+        :type executor: :class:`temscript.executor.MicroscopeExecutor`
+        """
+        from .stream import FrameStream
+        n_frames = kw.pop("n_frames", None)
+        buffer_size = kw.pop("buffer_size", 8)
+        executor = kw.pop("executor", None)
+        if kw:
+            raise TypeError("Unexpected keyword arguments: %s" % ", ".join(kw.keys()))
+        self.stop_stream()
+        self._set_acq_devices(detectors)
+        self._stream = FrameStream(self._acquire_images, n_frames=n_frames, buffer_size=buffer_size,
+                                   executor=executor)
+
+    def stop_stream(self):
+        """Stop continuous acquisition (after the current frame). Buffered frames can still be read."""
+        if self._stream is not None:
+            self._stream.stop()
+
+    def get_frame_stream(self):
+        """
+        Return :class:`temscript.stream.FrameStream` of the last continuous acquisition (or None).
+        """
+        return self._stream
+
     def get_image_shift(self):
         """
         Return image shift as (x,y) tuple in meters.
@@ -916,37 +1068,46 @@ class Microscope(object):
         """
         self._tem_illumination.BeamBlanked = beam_blanked
 
-    def get_optics_state(self):
+    # Getters of the optics state fields. Fields with the same getter are read only once per snapshot.
+    _OPTICS_STATE_GETTERS = {
+        "family": "get_family",
+        "microscope_id": "get_microscope_id",
+        "temscript_version": "get_version",
+        "voltage(kV)": "get_voltage",
+        "stage_holder": "get_stage_holder",
+        "stage_position": "get_stage_position",
+        "image_shift": "get_image_shift",
+        "beam_shift": "get_beam_shift",
+        "beam_tilt": "get_beam_tilt",
+        "projection_sub_mode": "get_projection_sub_mode",
+        "projection_mode": "get_projection_mode",
+        "projection_mode_string": "get_projection_sub_mode",
+        "magnification_index": "get_magnification_index",
+        "indicated_camera_length": "get_indicated_camera_length",
+        "indicated_magnification": "get_indicated_magnification",
+        "defocus": "get_defocus",
+        "objective_excitation": "get_objective_excitation",
+        "intensity": "get_intensity",
+        "condenser_stigmator": "get_condenser_stigmator",
+        "objective_stigmator": "get_objective_stigmator",
+        "diffraction_shift": "get_diffraction_shift",
+    }
+
+    def get_optics_state(self, fields=None):
         """
         Return a dictionary with state of microscope optics.
 
+        The static fields ("family", "microscope_id", "temscript_version") are only read once. Each value is read only
+        once per call, even if it is used by several fields.
+
+        :param fields: Names of the fields to return (default: None, all fields, see :data:`OPTICS_STATE_FIELDS`)
+        :type fields: list of str
+        :raises ValueError: If a field is unknown
+
         .. versionadded:: 1.0.9
         """
-        state = {
-            "family": self.get_family(),
-            "microscope_id": self.get_microscope_id(),
-            "temscript_version": self.get_version(),
-            "voltage(kV)": self.get_voltage(),
-            "stage_holder": self.get_stage_holder(),
-            "stage_position": self.get_stage_position(),
-            "image_shift": self.get_image_shift(),
-            "beam_shift": self.get_beam_shift(),
-            "beam_tilt": self.get_beam_tilt(),
-            "projection_sub_mode": self.get_projection_sub_mode(),
-            "projection_mode": self.get_projection_mode(),
-            "projection_mode_string": self.get_projection_mode_string(),
-            "magnification_index": self.get_magnification_index(),
-            "indicated_camera_length": self.get_indicated_camera_length(),
-            "indicated_magnification": self.get_indicated_magnification(),
-            "defocus": self.get_defocus(),
-            "objective_excitation": self.get_objective_excitation(),
-            "intensity": self.get_intensity(),
-            "condenser_stigmator": self.get_condenser_stigmator(),
-            "objective_stigmator": self.get_objective_stigmator(),
-            "diffraction_shift": self.get_diffraction_shift(),
-        }
-        return state
-    
+        return _read_optics_state(self, self._OPTICS_STATE_GETTERS, fields, self._static_optics_state)
+
     def get_gun1(self):
         """
         Queries the Gun1 interface (in case it is not yet initialized) and returns it.
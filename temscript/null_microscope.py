@@ -3,7 +3,7 @@ import numpy as np
 from math import pi
 
 from .enums import *
-from .microscope import _parse_enum
+from .microscope import _parse_enum, _read_optics_state
 
 
 class NullMicroscope(object):
@@ -14,6 +14,16 @@ class NullMicroscope(object):
     :type wait_exposure: bool
     :param voltage: High tension value the microscope report in kV
     :type voltage: float
+    :param simulate_images: Whether the acquired images are simulated (see :class:`ImageSimulator`) instead of
+        being zero. Either a bool or an :class:`ImageSimulator` instance.
+    :param seed: Seed of the simulated specimen and noise (only used if `simulate_images` is True)
+    :type seed: int
+    :param frame_pool: Serve the images from a pool of precomputed frames (see :class:`FramePool`), keyed by
+        detector parameters. Either the number of frames kept per parameter set or a :class:`FramePool` instance
+        (default: None, generate each image). Pooled images don't follow changes of the optics.
+    :param timing: Emulate the timing of stage moves, normalizations and readout (see :class:`TimingModel`).
+        Either a bool or a :class:`TimingModel` instance (default: False, stage moves and normalizations are
+        instantaneous).
     """
     STAGE_XY_RANGE = 1e-3       # meters
     STAGE_Z_RANGE = 0.3e-3      # meters
@@ -21,8 +31,10 @@ class NullMicroscope(object):
 
     CCD_SIZE = 2048
     CCD_BINNINGS = [1, 2, 4, 8]
+    CCD_PIXEL_SIZE = 24e-6      # meters (as reported by get_detectors)
 
-    def __init__(self, wait_exposure=None, voltage=200.0):
+    def __init__(self, wait_exposure=None, voltage=200.0, simulate_images=False, seed=0,
+                 frame_pool=None, timing=False):
         self._column_valves = False
         self._stage_pos = { 'x': 0.0, 'y': 0.0, 'z': 0.0, 'a': 0.0, 'b': 0.0 }
         self._wait_exposure = bool(wait_exposure) if wait_exposure is not None else True
@@ -60,6 +72,22 @@ class NullMicroscope(object):
         self._intensity = 0.0
         self._beam_blanked = False
         self._voltage_offset = 0.0
+        self._stream = None
+        self._static_optics_state = {}
+        if simulate_images is True:
+            from .simulation import ImageSimulator
+            simulate_images = ImageSimulator(seed=seed)
+        self._simulator = simulate_images or None
+        if isinstance(frame_pool, int):
+            from .simulation import FramePool
+            frame_pool = FramePool(frames_per_key=frame_pool, seed=seed) if frame_pool > 0 else None
+        self._frame_pool = frame_pool
+        if timing is True:
+            from .simulation import TimingModel
+            timing = TimingModel()
+        self._timing = timing or None
+        self._stage_motion = None
+        self._lenses_settled = 0.0
 
     def get_family(self):
         return "NULL"
@@ -100,8 +128,14 @@ class NullMicroscope(object):
     def get_stage_holder(self):
         return "UNKNOWN"
 
+    def _current_stage_motion(self):
+        if self._stage_motion is not None and self._stage_motion.done(self._timing.clock.time()):
+            self._stage_motion = None
+        return self._stage_motion
+
     def get_stage_status(self):
-        return "READY"
+        motion = self._current_stage_motion()
+        return motion.status if motion is not None else "READY"
 
     def get_stage_limits(self):
         return {
@@ -113,12 +147,19 @@ class NullMicroscope(object):
         }
 
     def get_stage_position(self):
+        motion = self._current_stage_motion()
+        if motion is not None:
+            return motion.position(self._timing.clock.time())
         return dict(self._stage_pos)
 
     def set_stage_position(self, pos=None, method="GO", **kw):
         pos = dict(pos, **kw) if pos is not None else dict(**kw)
         if method not in ["GO", "MOVE"]:
             raise ValueError("Unknown movement methods.")
+        speed = float(pos.pop("speed", 1.0)) if method == "GO" else 1.0
+        if speed <= 0:
+            raise ValueError("Speed must be positive.")
+        start = self.get_stage_position()
         limit = self.get_stage_limits()
         for key in self._stage_pos.keys():
             if key not in pos:
@@ -126,6 +167,8 @@ class NullMicroscope(object):
             mn, mx = limit[key]
             value = max(mn, min(mx, float(pos[key])))
             self._stage_pos[key] = value
+        if self._timing is not None:
+            self._stage_motion = self._timing.move_stage(start, self._stage_pos, method, speed)
 
     def get_detectors(self):
         return {
@@ -158,7 +201,7 @@ class NullMicroscope(object):
             except Exception:
                 pass
             try:
-                binning = int(param["exposure(s)"])
+                binning = int(param["binning"])
                 if binning in self.CCD_BINNINGS:
                     self._ccd_param["binning"] = binning
             except Exception:
@@ -171,8 +214,16 @@ class NullMicroscope(object):
             raise TypeError("Unknown detector type.")
 
     def acquire(self, *args):
+        if self._stream is not None and self._stream.running:
+            raise RuntimeError("Acquisition stream is running.")
+        return self._acquire_images(set(args))
+
+    def _acquire_images(self, detectors):
+        if self._timing is not None:
+            # Wait for lenses to settle after normalization
+            clock = self._timing.clock
+            clock.sleep(self._lenses_settled - clock.time())
         result = {}
-        detectors = set(args)
         for det in detectors:
             if det == "CCD":
                 size = self.CCD_SIZE // self._ccd_param["binning"]
@@ -180,12 +231,51 @@ class NullMicroscope(object):
                     size //= 2
                 elif self._ccd_param["image_size"] == "QUARTER":
                     size //= 4
-                if self._wait_exposure:
+                if self._timing is not None:
+                    readout = self._timing.readout_duration(size * size, self.CCD_SIZE * self.CCD_SIZE)
+                    exposure = self._ccd_param["exposure(s)"] if self._wait_exposure else 0.0
+                    self._timing.clock.sleep(exposure + readout)
+                elif self._wait_exposure:
                     import time
                     time.sleep(self._ccd_param["exposure(s)"])
-                result["CCD"] = np.zeros((size, size), dtype=np.int16)
+                if self._frame_pool is not None:
+                    key = ("CCD", self._ccd_param["binning"], self._ccd_param["image_size"],
+                           self._ccd_param["exposure(s)"])
+                    result["CCD"] = self._frame_pool.get(key, lambda: self._generate_image(size))
+                else:
+                    result["CCD"] = self._generate_image(size)
         return result
 
+    def _generate_image(self, size):
+        if self._simulator is None:
+            return np.zeros((size, size), dtype=np.int16)
+        pos = self.get_stage_position()
+        # Magnification of the imaging mode is also used in diffraction mode
+        pixel_size = self.CCD_PIXEL_SIZE / (max(self._magnification_index, 1) * 10000)
+        return self._simulator.acquire((size, size), pixel_size, self._ccd_param["exposure(s)"],
+                                       binning=self._ccd_param["binning"],
+                                       position=(pos["x"], pos["y"]),
+                                       image_shift=self._image_shift, defocus=self._defocus)
+
+    def start_stream(self, *detectors, **kw):
+        from .stream import FrameStream
+        n_frames = kw.pop("n_frames", None)
+        buffer_size = kw.pop("buffer_size", 8)
+        executor = kw.pop("executor", None)
+        if kw:
+            raise TypeError("Unexpected keyword arguments: %s" % ", ".join(kw.keys()))
+        self.stop_stream()
+        detectors = set(detectors)
+        self._stream = FrameStream(lambda: self._acquire_images(detectors), n_frames=n_frames,
+                                   buffer_size=buffer_size, executor=executor)
+
+    def stop_stream(self):
+        if self._stream is not None:
+            self._stream.stop()
+
+    def get_frame_stream(self):
+        return self._stream
+
     def get_image_shift(self):
         return tuple(self._image_shift)
 
@@ -233,6 +323,9 @@ class NullMicroscope(object):
                        "OBJECTIVE_CONDENSER", "OBJECTIVE_PROJECTOR", "ALL"]
         if mode.upper() not in KNOWN_MODES:
             raise ValueError("Unknown normalization mode: %s" % mode)
+        if self._timing is not None:
+            now = self._timing.clock.time()
+            self._lenses_settled = max(now, self._lenses_settled) + self._timing.normalize_duration(mode)
 
     def get_instrument_mode(self):
         return self._instrument_mode
@@ -350,30 +443,29 @@ class NullMicroscope(object):
     def get_diffraction_shift(self):
         return tuple(self._diffraction_shift)
 
-    def get_optics_state(self):
-        state = {
-            "family": self.get_family(),
-            "microscope_id": self.get_microscope_id(),
-            "temscript_version": self.get_version(),
-            "voltage(kV)": self.get_voltage(),
-            "stage_holder": self.get_stage_holder(),
-            "stage_position": self.get_stage_position(),
-            "image_shift": self.get_image_shift(),
-            "beam_shift": self.get_beam_shift(),
-            "beam_tilt": self.get_beam_tilt(),
-            "projection_sub_mode": self.get_projection_sub_mode().name,
-            "projection_mode": self.get_projection_mode().name,
-            "projection_mode_string": self.get_projection_mode_string(),
-            "magnification_index": self.get_magnification_index(),
-            "indicated_camera_length": self.get_indicated_camera_length(),
-            "indicated_magnification": self.get_indicated_magnification(),
-            "defocus": self.get_defocus(),
-            "intensity": self.get_intensity(),
-            "objective_excitation": self.get_objective_excitation(),
-            "condenser_stigmator": self.get_condenser_stigmator(),
-            "objective_stigmator": self.get_objective_stigmator(),
-            "diffraction_shift": self.get_diffraction_shift(),
-        }
-        return state
-
-
+    _OPTICS_STATE_GETTERS = {
+        "family": "get_family",
+        "microscope_id": "get_microscope_id",
+        "temscript_version": "get_version",
+        "voltage(kV)": "get_voltage",
+        "stage_holder": "get_stage_holder",
+        "stage_position": "get_stage_position",
+        "image_shift": "get_image_shift",
+        "beam_shift": "get_beam_shift",
+        "beam_tilt": "get_beam_tilt",
+        "projection_sub_mode": "get_projection_mode_string",
+        "projection_mode": "get_projection_mode_type_string",
+        "projection_mode_string": "get_projection_mode_string",
+        "magnification_index": "get_magnification_index",
+        "indicated_camera_length": "get_indicated_camera_length",
+        "indicated_magnification": "get_indicated_magnification",
+        "defocus": "get_defocus",
+        "objective_excitation": "get_objective_excitation",
+        "intensity": "get_intensity",
+        "condenser_stigmator": "get_condenser_stigmator",
+        "objective_stigmator": "get_objective_stigmator",
+        "diffraction_shift": "get_diffraction_shift",
+    }
+
+    def get_optics_state(self, fields=None):
+        return _read_optics_state(self, self._OPTICS_STATE_GETTERS, fields, self._static_optics_state)
@@ -2,19 +2,125 @@
 from __future__ import division, print_function
 import numpy as np
 import json
+import select
 import socket
+import threading
+
+from .array_transport import NDARRAY_CONTENT_TYPE, decode_ndarrays
+from .compression import accept_encoding, decompress
+from .stream import STREAM_CONTENT_TYPE, FRAME_HEADER
 
 # Get imports from library
 try:
     # Python 3.X
-    from http.client import HTTPConnection
+    from http.client import HTTPConnection, HTTPException
     from urllib.parse import urlencode
     from io import BytesIO
+    import queue
 except ImportError:
     # Python 2.X
-    from httplib import HTTPConnection
+    from httplib import HTTPConnection, HTTPException
     from urllib import urlencode
     from cStringIO import StringIO as BytesIO
+    import Queue as queue
+
+
+def _decode_json_arrays(body):
+    """Unpack dict of arrays encoded by the JSON transport"""
+    import sys
+    import base64
+    endianness = sys.byteorder.upper()
+    result = {}
+    for k, v in body.items():
+        shape = int(v["height"]), int(v["width"])
+        if v["type"] not in RemoteMicroscope.allowed_types:
+            raise ValueError("Unsupported array type in JSON stream: %s" % str(v["type"]))
+        if v["endianness"] not in RemoteMicroscope.allowed_endianness:
+            raise ValueError("Unsupported endianness in JSON stream: %s" % str(v["endianness"]))
+        dtype = np.dtype(v["type"].lower())
+        if v["encoding"] == "BASE64":
+            data = base64.b64decode(v["data"])
+        else:
+            raise ValueError("Unsupported encoding of array in JSON stream: %s" % str(v["encoding"]))
+        data = np.frombuffer(data, dtype=dtype).reshape(*shape)
+        if v["endianness"] != endianness:
+            data = data.byteswap()
+        result[k] = data
+    return result
+
+
+def _is_dropped(conn):
+    """Whether the server closed the idle connection `conn` (it is readable, i.e. at EOF)"""
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+class _ConnectionPool(object):
+    """
+    Thread-safe pool of keep-alive HTTP connections.
+
+    At most `size` connections are in use at the same time, further callers block until a connection is released.
+    """
+    def __init__(self, address, size, timeout):
+        self.address = address
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._stats = {"size": size, "in_use": 0, "created": 0, "reused": 0, "reconnects": 0}
+
+    def acquire(self):
+        """Get connection from pool (or create new one). Returns (connection, reused) tuple."""
+        self._slots.acquire()
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+                reused = False
+                break
+            # Connections closed by the server after its keep-alive timeout are discarded
+            if not _is_dropped(conn):
+                reused = True
+                break
+            conn.close()
+        with self._lock:
+            self._stats["in_use"] += 1
+            self._stats["reused" if reused else "created"] += 1
+        return conn, reused
+
+    def release(self, conn, reuse=True):
+        """Return connection to pool. If `reuse` is false, the connection is closed."""
+        if reuse:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        with self._lock:
+            self._stats["in_use"] -= 1
+        self._slots.release()
+
+    def count_reconnect(self):
+        with self._lock:
+            self._stats["reconnects"] += 1
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+        result["idle"] = self._idle.qsize()
+        return result
 
 
 class RemoteMicroscope(object):
@@ -23,13 +129,19 @@ class RemoteMicroscope(object):
 
     Use the ``temscript-server`` command line script to run a microscope server.
 
+    The instance can be shared between threads: Requests are sent over a pool of keep-alive connections.
+    GET requests failing on a reused connection (e.g. closed by the server meanwhile) are transparently
+    repeated on a new connection.
+
     :param address: (host, port) combination for the remote microscope.
     :param transport: Underlying transport protocol, either 'JSON' (default) or 'pickle'
+    :param timeout: Timeout of requests in seconds (default: None, no timeout)
+    :param pool_size: Maximum number of concurrent connections (default: 4)
     """
-    def __init__(self, address, transport=None, timeout=None):
+    def __init__(self, address, transport=None, timeout=None, pool_size=4):
         self.address = address
         self.timeout = timeout
-        self._conn = None
+        self._pool = _ConnectionPool(address, pool_size, timeout)
         if transport is None:
             transport = "JSON"
         if transport == "JSON":
@@ -40,10 +152,6 @@ class RemoteMicroscope(object):
             raise ValueError("Unknown transport protocol.")
 
     def _request(self, method, endpoint, query={}, body=None, headers={}, accepted_response=[200]):
-        # Make connection
-        if self._conn is None:
-            self._conn = HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
-
         # Create request
         if len(query) > 0:
             url = "%s?%s" % (endpoint, urlencode(query))
@@ -53,18 +161,31 @@ class RemoteMicroscope(object):
         if "Accept" not in headers:
             headers["Accept"] = ",".join(self.accepted_content)
         if "Accept-Encoding" not in headers:
-            headers["Accept-Encoding"] = "gzip"
-        self._conn.request(method, url, body, headers)
-
-        # Get response
-        try:
-            response = self._conn.getresponse()
-        except socket.timeout:
-            self._conn.close()
-            self._conn = None
-            raise
-
-        body = response.read()
+            headers["Accept-Encoding"] = accept_encoding()
+
+        # Send request and get response
+        retry = method == "GET"
+        while True:
+            conn, reused = self._pool.acquire()
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                response_body = response.read()
+            except socket.timeout:
+                self._pool.release(conn, reuse=False)
+                raise
+            except (socket.error, HTTPException):
+                self._pool.release(conn, reuse=False)
+                # Stale keep-alive connection: repeat idempotent requests once on new connection
+                if reused and retry:
+                    retry = False
+                    self._pool.count_reconnect()
+                    continue
+                raise
+            self._pool.release(conn, reuse=not response.will_close)
+            break
+
+        body = response_body
         if response.status not in accepted_response:
             raise ValueError("Failed remote call: %d, %s" % (response.status, response.reason))
         if response.status == 204:
@@ -72,12 +193,14 @@ class RemoteMicroscope(object):
 
         # Decode response
         content_type = response.getheader("Content-Type")
-        if content_type not in self.accepted_content:
+        if content_type not in headers["Accept"].split(","):
             raise ValueError("Unexpected response type: {}".format(content_type))
-        if response.getheader("Content-Encoding") == "gzip":
-            import zlib
-            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
-        if content_type == "application/json":
+        content_encoding = response.getheader("Content-Encoding")
+        if content_encoding:
+            body = decompress(body, content_encoding)
+        if content_type == NDARRAY_CONTENT_TYPE:
+            body = decode_ndarrays(body)
+        elif content_type == "application/json":
             body = json.loads(body.decode("utf-8"))
         elif content_type == "application/python-pickle":
             import pickle
@@ -86,6 +209,49 @@ class RemoteMicroscope(object):
             raise ValueError("Unsupported response type: %s", content_type)
         return response, body
 
+    def get_pool_stats(self):
+        """
+        Return statistics of the connection pool as dict with the keys "size", "in_use", "idle", "created",
+        "reused", and "reconnects".
+        """
+        return self._pool.stats()
+
+    def close(self):
+        """Close all idle connections."""
+        self._pool.close()
+
+    def get_many(self, *names):
+        """
+        Read several properties with one request.
+
+        :param names: Names of the properties (e.g. "defocus", "intensity", "detector_param/CCD")
+        :returns: dict with values indexed by name
+        """
+        query = [("props", name) for name in names]
+        response, body = self._request("GET", "/v1/batch", query=query)
+        return body
+
+    def set_many(self, operations):
+        """
+        Set several properties with one request.
+
+        The operations are applied in order on the server. The batch is atomic: If an operation fails,
+        the remaining operations are skipped and the already applied operations are rolled back to their
+        previous values (except operations without getter, like "normalize").
+
+        :param operations: List of (name, value) pairs or dict with values indexed by name
+            (e.g. ``[("beam_shift", (0.0, 1e-9)), ("defocus", -1e-6)]``)
+        :returns: List with a result dict for each operation, with keys "endpoint", "success" and
+            - for failed operations - "error", "skipped" or "rolled_back" (or "rollback_error", if an
+            applied operation couldn't be rolled back).
+        """
+        if isinstance(operations, dict):
+            operations = operations.items()
+        content = json.dumps([(name, value) for name, value in operations]).encode("utf-8")
+        response, body = self._request("PUT", "/v1/batch", body=content, accepted_response=[200],
+                                       headers={"Content-Type": "application/json"})
+        return body
+
     def get_family(self):
         response, body = self._request("GET", "/v1/family")
         return body
@@ -212,35 +378,80 @@ class RemoteMicroscope(object):
 
     def acquire(self, *detectors):
         query = [("detectors", det) for det in detectors]
-        response, body = self._request("GET", "/v1/acquire", query=query)
+        # Prefer binary array transport, servers not supporting it fall back to the regular transport
+        accept = ",".join([NDARRAY_CONTENT_TYPE] + self.accepted_content)
+        response, body = self._request("GET", "/v1/acquire", query=query, headers={"Accept": accept})
         if response.getheader("Content-Type") == "application/json":
-            # Unpack array
-            import sys
-            import base64
-            endianness = sys.byteorder.upper()
-            result = {}
-            for k, v in body.items():
-                shape = int(v["height"]), int(v["width"])
-                if v["type"] not in self.allowed_types:
-                    raise ValueError("Unsupported array type in JSON stream: %s" % str(v["type"]))
-                if v["endianness"] not in self.allowed_endianness:
-                    raise ValueError("Unsupported endianness in JSON stream: %s" % str(v["endianness"]))
-                dtype = np.dtype(v["type"].lower())
-                if v["encoding"] == "BASE64":
-                    data = base64.b64decode(v["data"])
-                else:
-                    raise ValueError("Unsupported encoding of array in JSON stream: %s" % str(v["encoding"]))
-                data = np.frombuffer(data, dtype=dtype).reshape(*shape)
-                if v["endianness"] != endianness:
-                    data = data.byteswap()
-                result[k] = data
-            body = result
-        return body
+            body = _decode_json_arrays(body)
+        return body
+
+    def start_stream(self, *detectors, **kw):
+        """
+        Start continuous acquisition of images for all detectors given as argument on the server.
+
+        Requires a threaded server (``temscript-server --workers N``), since :meth:`stream` occupies a request
+        handler for the life of the stream.
+
+        :param n_frames: Number of frames to acquire (default: None, until :meth:`stop_stream` is called)
+        :param buffer_size: Number of frames buffered on the server (default: 8)
+        """
+        n_frames = kw.pop("n_frames", None)
+        buffer_size = kw.pop("buffer_size", 8)
+        if kw:
+            raise TypeError("Unexpected keyword arguments: %s" % ", ".join(kw.keys()))
+        content = json.dumps({"detectors": detectors, "n_frames": n_frames,
+                              "buffer_size": buffer_size}).encode("utf-8")
+        self._request("PUT", "/v1/stream", body=content, accepted_response=[200, 204],
+                      headers={"Content-Type": "application/json"})
+
+    def stop_stream(self):
+        """Stop continuous acquisition on the server."""
+        self._request("PUT", "/v1/stream", body=b"null", accepted_response=[200, 204],
+                      headers={"Content-Type": "application/json"})
+
+    def stream(self, since=0):
+        """
+        Iterate over the frames of the continuous acquisition started by :meth:`start_stream`.
+
+        The frames are received over a dedicated connection. Each frame is a tuple (sequence number,
+        dict of images indexed by detector name). Gaps in the sequence numbers indicate frames dropped
+        from the ring buffer of the server. The iteration ends, when the stream is stopped.
+
+            >>> microscope.start_stream("CCD")
+            >>> for seq, images in microscope.stream():
+            ...     show(images["CCD"])
+
+        :param since: Sequence number of the last frame already received (default: 0, start with the oldest
+            buffered frame)
+        """
+        conn = HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+        try:
+            conn.request("GET", "/v1/stream?%s" % urlencode({"since": int(since)}),
+                         headers={"Accept": STREAM_CONTENT_TYPE})
+            response = conn.getresponse()
+            if response.status != 200:
+                raise ValueError("Failed remote call: %d, %s" % (response.status, response.reason))
+            content_type = response.getheader("Content-Type")
+            if content_type != STREAM_CONTENT_TYPE:
+                raise ValueError("Unexpected response type: {}".format(content_type))
+            while True:
+                header = response.read(FRAME_HEADER.size)
+                if not header:
+                    break
+                if len(header) != FRAME_HEADER.size:
+                    raise ValueError("Incomplete frame in stream.")
+                seq, length = FRAME_HEADER.unpack(header)
+                data = response.read(length)
+                if len(data) != length:
+                    raise ValueError("Incomplete frame in stream.")
+                yield seq, decode_ndarrays(data)
+        finally:
+            conn.close()
 
     def normalize(self, mode="ALL"):
         mode = str(mode)
         content = json.dumps(mode).encode("utf-8")
-        self._request("PUT", "/v1/acquire", body=content, accepted_response=[200, 204],
+        self._request("PUT", "/v1/normalize", body=content, accepted_response=[200, 204],
                       headers={"Content-Type": "application/json"})
 
     def get_instrument_mode(self):
@@ -399,8 +610,18 @@ class RemoteMicroscope(object):
         self._request("PUT", "/v1/diffraction_shift", body=content, accepted_response=[200, 204],
                       headers={"Content-Type": "application/json"})
 
-    def get_optics_state(self):
-        response, body = self._request("GET", "/v1/optics_state")
+    def get_optics_state(self, fields=None):
+        """
+        Return a dictionary with state of microscope optics.
+
+        :param fields: Names of the fields to return (default: None, all fields)
+        """
+        query = [("fields", field) for field in fields] if fields is not None else {}
+        response, body = self._request("GET", "/v1/optics_state", query=query)
+        return body
+
+    def get_cache_stats(self):
+        response, body = self._request("GET", "/v1/cache_stats")
         return body
 
 
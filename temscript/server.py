@@ -2,62 +2,110 @@
 from __future__ import division, print_function
 import numpy as np
 import json
+import select
+import socket
+import threading
+import time
 import traceback
 
-from .microscope import STAGE_AXES
+from .endpoints import EndpointError, get_value, set_value, get_values
+from .array_transport import NDARRAY_CONTENT_TYPE, is_ndarray_dict, encode_ndarrays
+from .compression import SHUFFLE_TOKEN, parse_accept_encoding, choose_codec, compressobj
+from .stream import STREAM_CONTENT_TYPE, FRAME_HEADER
 
 # Get imports from library
 try:
     # Python 3.X
     from http.server import BaseHTTPRequestHandler, HTTPServer
     from urllib.parse import urlparse, parse_qs, quote
-    from io import BytesIO
 except ImportError:
     # Python 2.X
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from urlparse import urlparse, parse_qs
     from urllib import pathname2url as quote
-    from cStringIO import StringIO as BytesIO
 
 
 # Numpy array encoding JSON encoder
 class ArrayJSONEncoder(json.JSONEncoder):
     allowed_dtypes = {"INT8", "INT16", "INT32", "INT64", "UINT8", "UINT16", "UINT32", "UINT64", "FLOAT32", "FLOAT64"}
 
+    def array_header(self, obj):
+        """Return encoding of array 'obj' without its 'data' entry, or None if its type isn't supported"""
+        import sys
+
+        dtype_name = obj.dtype.name.upper()
+        if dtype_name not in self.allowed_dtypes:
+            return None
+
+        if obj.dtype.byteorder == '<':
+            endian = "LITTLE"
+        elif obj.dtype.byteorder == '>':
+            endian = "BIG"
+        else:
+            endian = sys.byteorder.upper()
+
+        return {
+            'width': obj.shape[1],
+            'height': obj.shape[0],
+            'type': dtype_name,
+            'endianness': endian,
+            'encoding': "BASE64"
+        }
+
     def default(self, obj):
         if isinstance(obj, np.ndarray):
-            import sys, base64
+            import base64
 
-            dtype_name = obj.dtype.name.upper()
-            if dtype_name not in self.allowed_dtypes:
+            header = self.array_header(obj)
+            if header is None:
                 return json.JSONEncoder.default(self, obj)
-
-            if obj.dtype.byteorder == '<':
-                endian = "LITTLE"
-            elif obj.dtype.byteorder == '>':
-                endian = "BIG"
-            else:
-                endian = sys.byteorder.upper()
-
-            return {
-                'width': obj.shape[1],
-                'height': obj.shape[0],
-                'type': dtype_name,
-                'endianness': endian,
-                'encoding': "BASE64",
-                'data': base64.b64encode(obj).decode("ascii")
-            }
+            header['data'] = base64.b64encode(obj).decode("ascii")
+            return header
         return json.JSONEncoder.default(self, obj)
 
 
-def _gzipencode(content):
-    """GZIP encode bytes object"""
-    import gzip
-    out = BytesIO()
-    f = gzip.GzipFile(fileobj=out, mode='w', compresslevel=5)
-    f.write(content)
-    f.close()
-    return out.getvalue()
+# Size of the chunks written for streamed responses
+_CHUNK_SIZE = 1 << 20
+
+
+def _iter_slices(chunks, size=_CHUNK_SIZE):
+    """Split bytes-like objects into slices of at most 'size' bytes (without copying)"""
+    for chunk in chunks:
+        view = memoryview(chunk)
+        for start in range(0, len(view), size):
+            yield view[start:start + size]
+
+
+def _iter_json_ndarrays(arrays, size=_CHUNK_SIZE):
+    """
+    Encode dict of numpy arrays as JSON (like ArrayJSONEncoder). The base64 encoded data of each array
+    is yielded in blocks of at most 'size' bytes.
+    """
+    import base64
+
+    encoder = ArrayJSONEncoder()
+    # Slices of a multiple of 3 bytes are encoded without padding, so the blocks can be concatenated
+    step = max(size // 4, 1) * 3
+    separator = "{"
+    for name, array in arrays.items():
+        header = encoder.encode(encoder.array_header(array))
+        yield (separator + encoder.encode(name) + ": " + header[:-1] + ', "data": "').encode("utf-8")
+        data = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        for start in range(0, data.size, step):
+            yield base64.b64encode(data[start:start + step])
+        yield b'"}'
+        separator = ", "
+    yield b"}"
+
+
+def _compress_stream(chunks, codec, level=5):
+    """Compress bytes-like objects yielded by 'chunks' block by block"""
+    compressor = compressobj(codec, level)
+    for chunk in _iter_slices(chunks):
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
 
 
 def _parse_enum(type, item):
@@ -69,142 +117,165 @@ def _parse_enum(type, item):
 
 
 class MicroscopeHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections (all responses have a Content-Length or use chunked transfer encoding)
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are written separately: with Nagle's algorithm, the body would be delayed
+    # until the client (delaying its ACK) acknowledges the headers on kept alive connections
+    disable_nagle_algorithm = True
+
+    def keep_alive(self):
+        """Whether the server keeps connections alive (a sequential server closes them after each response)"""
+        return getattr(self.server, "keep_alive_timeout", 0) > 0
+
+    def end_headers(self):
+        if not self.close_connection and not self.keep_alive():
+            self.send_header('Connection', 'close')
+        BaseHTTPRequestHandler.end_headers(self)
+
+    def handle(self):
+        # One request per handler: Kept alive connections are watched by the server while idle and handled
+        # by a new handler, when the next request arrives (see ThreadedMicroscopeServer)
+        self.close_connection = True
+        self.handle_one_request()
+
     def build_response(self, response):
         if response is None:
             self.send_response(204)
             self.end_headers()
             return
-        self.send_response(200)
 
         # Transport encoding
         accept_type = [x.split(';', 1)[0].strip() for x in self.headers.get("Accept", "").split(",")]
-        if "application/python-pickle" in accept_type:
+        accept_encoding = parse_accept_encoding(self.headers.get("Accept-Encoding", ""))
+        compress_level = getattr(self.server, "compress_level", 5)
+        has_arrays = is_ndarray_dict(response)
+        if NDARRAY_CONTENT_TYPE in accept_type and has_arrays:
+            # Arrays are written directly from their buffers (byte shuffled, if compressed and client supports it)
+            shuffle = (compress_level > 0 and SHUFFLE_TOKEN in accept_encoding and
+                       choose_codec(accept_encoding) is not None)
+            chunks = encode_ndarrays(response, shuffle=shuffle)
+            content_type = NDARRAY_CONTENT_TYPE
+        elif "application/python-pickle" in accept_type:
             import pickle
-            encoded_response = pickle.dumps(response, protocol=2)
+            chunks = [pickle.dumps(response, protocol=2)]
             content_type = "application/python-pickle"
+        elif has_arrays:
+            # Encode (large) images block by block while sending
+            chunks = _iter_json_ndarrays(response)
+            content_type = "application/json"
         else:
-            encoded_response = ArrayJSONEncoder().encode(response).encode("utf-8")
+            chunks = [ArrayJSONEncoder().encode(response).encode("utf-8")]
             content_type = "application/json"
 
-        # Compression?
-        accept_encoding = [x.split(';', 1)[0].strip() for x in self.headers.get("Accept-Encoding", "").split(",")]
-        if len(encoded_response) > 256 and 'gzip' in accept_encoding:
-            encoded_response = _gzipencode(encoded_response)
-            self.send_header('Content-Encoding', 'gzip')
+        # Size of body is only known in advance for lists of chunks
+        length = sum(len(chunk) for chunk in chunks) if isinstance(chunks, list) else None
+
+        # Compression? (codec is chosen by size of response)
+        codec = choose_codec(accept_encoding, length) if compress_level > 0 else None
+        if codec is not None:
+            chunks = _compress_stream(chunks, codec, compress_level)
+            length = None
+
+        # Chunked transfer encoding requires a HTTP/1.1 client. Otherwise the body is joined to get its length.
+        chunked = length is None and self.request_version == "HTTP/1.1"
+        if length is None and not chunked:
+            chunks = [b"".join(chunks)]
+            length = len(chunks[0])
+
+        self.send_response(200)
+        if codec is not None:
+            self.send_header('Content-Encoding', codec)
         self.send_header('Content-Type', content_type)
-        # add content length of the body to avoid accidental "partial download error" with twisted.web.client which
-        # assumes the body to be chunk-encoded
-        self.send_header('Content-Length', str(len(encoded_response)))
-        self.end_headers()
-        self.wfile.write(encoded_response)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in chunks:
+                self.write_chunk([chunk])
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            # add content length of the body to avoid accidental "partial download error" with twisted.web.client
+            # which assumes the body to be chunk-encoded
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            for chunk in chunks:
+                self.wfile.write(chunk)
         return
 
+    def write_chunk(self, parts):
+        """Write bytes-like objects in 'parts' as one chunk of chunked transfer encoding"""
+        length = sum(len(part) for part in parts)
+        if length:
+            self.wfile.write(("%X\r\n" % length).encode("ascii"))
+            for part in parts:
+                self.wfile.write(part)
+            self.wfile.write(b"\r\n")
+
+    def send_stream(self, query):
+        """Send frames of the continuous acquisition until the stream ends (or the client disconnects)"""
+        stream = self.server.microscope.get_frame_stream()
+        if stream is None:
+            self.send_error(404, 'No acquisition stream: %s' % self.path)
+            return
+        try:
+            seq = int(query.get("since", ["0"])[0])
+        except ValueError:
+            self.send_error(404, 'Invalid sequence number: %s' % self.path)
+            return
+
+        # Without chunked transfer encoding (HTTP/1.0) the end of the stream is signalled by closing the connection
+        chunked = self.request_version == "HTTP/1.1"
+        self.send_response(200)
+        self.send_header('Content-Type', STREAM_CONTENT_TYPE)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    item = stream.next_frame(seq)
+                except Exception:
+                    self.log_error("Exception raised during acquisition stream: %s\n%s",
+                                   self.path, traceback.format_exc())
+                    return
+                if item is None:
+                    break
+                seq, frames = item
+                chunks = encode_ndarrays(frames)
+                parts = [FRAME_HEADER.pack(seq, sum(len(chunk) for chunk in chunks))] + chunks
+                if chunked:
+                    self.write_chunk(parts)
+                else:
+                    for part in parts:
+                        self.wfile.write(part)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except socket.error:
+            # Client disconnected
+            pass
+
+    def check_stream_support(self):
+        """
+        Return whether the server supports the acquisition stream, otherwise send error response.
+
+        The stream is read by a long running GET request, so stopping it requires a concurrent request.
+        """
+        if isinstance(self.server, ThreadedMicroscopeServer):
+            return True
+        self.send_error(501, 'Acquisition stream requires threaded server (--workers): %s' % self.path)
+        return False
+
     # Handler for V1 GETs
     def do_GET_V1(self, endpoint, query):
-        # Check for known endpoints
-        response = None
-        if endpoint == "family":
-            response = self.server.microscope.get_family()
-        elif endpoint == "microscope_id":
-            response = self.server.microscope.get_microscope_id()
-        elif endpoint == "version":
-            response = self.server.microscope.get_version()
-        elif endpoint == "voltage":
-            response = self.server.microscope.get_voltage()
-        elif endpoint == "vacuum":
-            response = self.server.microscope.get_vacuum()
-        elif endpoint == "stage_holder":
-            response = self.server.microscope.get_stage_holder()
-        elif endpoint == "stage_status":
-            response = self.server.microscope.get_stage_status()
-        elif endpoint == "stage_position":
-            response = self.server.microscope.get_stage_position()
-        elif endpoint == "stage_limits":
-            response = self.server.microscope.get_stage_limits()
-        elif endpoint == "detectors":
-            response = self.server.microscope.get_detectors()
-        elif endpoint == "image_shift":
-            response = self.server.microscope.get_image_shift()
-        elif endpoint == "beam_shift":
-            response = self.server.microscope.get_beam_shift()
-        elif endpoint == "beam_tilt":
-            response = self.server.microscope.get_beam_tilt()
-        elif endpoint == "instrument_mode":
-            response = self.server.microscope.get_instrument_mode()
-        elif endpoint == "instrument_mode_string":
-            response = self.server.microscope.get_instrument_mode_string()
-        elif endpoint == "df_mode":
-            response = self.server.microscope.get_df_mode()
-        elif endpoint == "df_mode_string":
-            response = self.server.microscope.get_df_mode_string()
-        elif endpoint == "projection_sub_mode":
-            response = self.server.microscope.get_projection_sub_mode()
-        elif endpoint == "projection_mode":
-            response = self.server.microscope.get_projection_mode()
-        elif endpoint == "projection_mode_string":
-            response = self.server.microscope.get_projection_mode_string()
-        elif endpoint == "projection_mode_type_string":
-            response = self.server.microscope.get_projection_mode_type_string()
-        elif endpoint == "lens_program":
-            response = self.server.microscope.get_lens_program()
-        elif endpoint == "lens_program_string":
-            response = self.server.microscope.get_lens_program_string()
-        elif endpoint == "illumination_mode":
-            response = self.server.microscope.get_illumination_mode()
-        elif endpoint == "illumination_mode_string":
-            response = self.server.microscope.get_illumination_mode_string()
-        elif endpoint == "illuminated_area":
-            response = self.server.microscope.get_illuminated_area()
-        elif endpoint == "convergence_angle":
-            response = self.server.microscope.get_convergence_angle()
-        elif endpoint == "condenser_mode":
-            response = self.server.microscope.get_condenser_mode()
-        elif endpoint == "condenser_mode_string":
-            response = self.server.microscope.get_condenser_mode_string()
-        elif endpoint == "spot_size_index":
-            response = self.server.microscope.get_spot_size_index()
-        elif endpoint == "magnification_index":
-            response = self.server.microscope.get_magnification_index()
-        elif endpoint == "stem_magnification":
-            response = self.server.microscope.get_stem_magnification()
-        elif endpoint == "indicated_camera_length":
-            response = self.server.microscope.get_indicated_camera_length()
-        elif endpoint == "indicated_magnification":
-            response = self.server.microscope.get_indicated_magnification()
-        elif endpoint == "defocus":
-            response = self.server.microscope.get_defocus()
-        elif endpoint == "probe_defocus":
-            response = self.server.microscope.get_probe_defocus()
-        elif endpoint == "objective_excitation":
-            response = self.server.microscope.get_objective_excitation()
-        elif endpoint == "intensity":
-            response = self.server.microscope.get_intensity()
-        elif endpoint == "objective_stigmator":
-            response = self.server.microscope.get_objective_stigmator()
-        elif endpoint == "condenser_stigmator":
-            response = self.server.microscope.get_condenser_stigmator()
-        elif endpoint == "diffraction_shift":
-            response = self.server.microscope.get_diffraction_shift()
-        elif endpoint == "optics_state":
-            response = self.server.microscope.get_optics_state()
-        elif endpoint == "beam_blanked":
-            response = self.server.microscope.get_beam_blanked()
-        elif endpoint.startswith("detector_param/"):
-            try:
-                name = endpoint[15:]
-                response = self.server.microscope.get_detector_param(name)
-            except KeyError:
-                self.send_error(404, 'Unknown detector: %s' % self.path)
-                return
-        elif endpoint == "acquire":
-            try:
-                detectors = query["detectors"]
-            except KeyError:
-                self.send_error(404, 'No detectors: %s' % self.path)
-                return
-            response = self.server.microscope.acquire(*detectors)
-        else:
-            self.send_error(404, 'Unknown endpoint: %s' % self.path)
+        if endpoint == "stream":
+            if self.check_stream_support():
+                self.send_stream(query)
+            return
+        try:
+            response = get_value(self.server.microscope, endpoint, query)
+        except EndpointError as exc:
+            self.send_error(404, '%s: %s' % (exc, self.path))
             return
         self.build_response(response)
 
@@ -217,65 +288,33 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
         content = self.rfile.read(length)
         decoded_content = json.loads(content.decode("utf-8"))
 
-        # Check for known endpoints
-        response = None
-        if endpoint == "stage_position":
-            method = decoded_content.get("method", "GO")
-            pos = dict((k, decoded_content[k]) for k in decoded_content.keys() if k in STAGE_AXES)
-            try:
-                pos['speed'] = decoded_content['speed']
-            except KeyError:
-                pass
-            self.server.microscope.set_stage_position(pos, method=method)
-        elif endpoint == "image_shift":
-            self.server.microscope.set_image_shift(decoded_content)
-        elif endpoint == "beam_shift":
-            self.server.microscope.set_beam_shift(decoded_content)
-        elif endpoint == "beam_tilt":
-            self.server.microscope.set_beam_tilt(decoded_content)
-        elif endpoint == "df_mode":
-            self.server.microscope.set_df_mode(decoded_content)
-        elif endpoint == "illuminated_area":
-            self.server.microscope.set_illuminated_area(decoded_content)
-        elif endpoint == "projection_mode":
-            self.server.microscope.set_projection_mode(decoded_content)
-        elif endpoint == "lens_program":
-            self.server.microscope.set_lens_program(decoded_content)
-        elif endpoint == "magnification_index":
-            self.server.microscope.set_magnification_index(decoded_content)
-        elif endpoint == "stem_magnification":
-            self.server.microscope.set_stem_magnification(decoded_content)
-        elif endpoint == "defocus":
-            self.server.microscope.set_defocus(decoded_content)
-        elif endpoint == "probe_defocus":
-            self.server.microscope.set_probe_defocus(decoded_content)
-        elif endpoint == "intensity":
-            self.server.microscope.set_intensity(decoded_content)
-        elif endpoint == "diffraction_shift":
-            self.server.microscope.set_diffraction_shift(decoded_content)
-        elif endpoint == "objective_stigmator":
-            self.server.microscope.set_objective_stigmator(decoded_content)
-        elif endpoint == "condenser_stigmator":
-            self.server.microscope.set_condenser_stigmator(decoded_content)
-        elif endpoint == "beam_blanked":
-            self.server.microscope.set_beam_blanked(decoded_content)
-        elif endpoint.startswith("detector_param/"):
-            try:
-                name = endpoint[15:]
-                response = self.server.microscope.set_detector_param(name, decoded_content)
-            except KeyError:
-                self.send_error(404, 'Unknown detector: %s' % self.path)
-                return
-        elif endpoint == "normalize":
-            mode = decoded_content
-            try:
-                self.server.microscope.normalize(mode)
-            except ValueError:
-                self.send_error(404, 'Unknown mode.' % mode)
-                return
-        else:
+        if endpoint == "stream" and not self.check_stream_support():
+            return
+        try:
+            response = set_value(self.server.microscope, endpoint, decoded_content)
+        except EndpointError as exc:
+            self.send_error(404, '%s: %s' % (exc, self.path))
+            return
+        self.build_response(response)
+
+    # Handler for V1 POSTs
+    def do_POST_V1(self, endpoint, query):
+        # Read content
+        length = int(self.headers['Content-Length'])
+        if length > 4096:
+            raise ValueError("Too much content...")
+        content = self.rfile.read(length)
+        decoded_content = json.loads(content.decode("utf-8"))
+
+        # Only batch requests are accepted as POST (with list of endpoints as content)
+        if endpoint != "batch":
             self.send_error(404, 'Unknown endpoint: %s' % self.path)
             return
+        try:
+            response = get_values(self.server.microscope, decoded_content)
+        except EndpointError as exc:
+            self.send_error(404, '%s: %s' % (exc, self.path))
+            return
         self.build_response(response)
 
     # Handler for the GET requests
@@ -306,14 +345,170 @@ class MicroscopeHandler(BaseHTTPRequestHandler):
                            self.path, traceback.format_exc())
             self.send_error(500, "Error handling request: %s" % self.path)
 
+    # Handler for the POST requests
+    def do_POST(self):
+        try:
+            request = urlparse(self.path)
+            if request.path.startswith("/v1/"):
+                self.do_POST_V1(request.path[4:], parse_qs(request.query))
+            else:
+                self.send_error(404, 'Unknown API version: %s' % self.path)
+            return
+        except Exception as exc:
+            self.log_error("Exception raised during handling of POST request: %s\n%s",
+                           self.path, traceback.format_exc())
+            self.send_error(500, "Error handling request: %s" % self.path)
+
 class MicroscopeServer(HTTPServer, object):
+    """
+    HTTP server for remote access to a microscope.
+
+    Requests are handled one after another, so the connection is closed after each response (a kept alive
+    connection would lock out other clients).
+
+    :param microscope_factory: Factory function for creation of microscope (default: :class:`Microscope`)
+    :type microscope_factory: callable without arguments
+    :param cache: Whether to cache the results of the microscope getters (see :class:`CachedMicroscope`)
+    :type cache: bool
+    :param cache_ttl: Time-to-live in seconds for cached non-static properties (default: 0.0, no caching)
+    :type cache_ttl: float
+    :param compress_level: Compression level for compressed responses (default: 5, 0: no compression)
+    :type compress_level: int
+    """
     def __init__(self, *args, **kw):
         microscope_factory = kw.pop("microscope_factory", None)
         if microscope_factory is None:
             from .microscope import Microscope
             microscope_factory = Microscope
+        cache = kw.pop("cache", False)
+        cache_ttl = kw.pop("cache_ttl", 0.0)
+        self.compress_level = kw.pop("compress_level", 5)
         super(MicroscopeServer, self).__init__(*args, **kw)
-        self.microscope = microscope_factory()
+        self.microscope = self.create_microscope(microscope_factory)
+        if cache:
+            from .cached_microscope import CachedMicroscope
+            self.microscope = CachedMicroscope(self.microscope, default_ttl=cache_ttl)
+
+    def create_microscope(self, microscope_factory):
+        """Create microscope instance used by the request handlers"""
+        return microscope_factory()
+
+
+class ThreadedMicroscopeServer(MicroscopeServer):
+    """
+    Microscope server, which handles requests concurrently on a bounded pool of worker threads.
+
+    Further requests are queued until a worker is available. All microscope calls are serialized
+    on a single executor thread (the microscope is also created there). Acquisitions, normalizations
+    and stage movements are executed on a second executor thread, so cheap reads are not blocked by them.
+    These calls release the GIL while the instrument is busy.
+
+    Requires Python 3 (:mod:`concurrent.futures`).
+
+    Connections are kept alive. While idle, they don't occupy a worker: They are watched by a separate thread
+    and handed to a worker, when the next request arrives.
+
+    :param workers: Number of worker threads (default: 4)
+    :type workers: int
+    :param keep_alive_timeout: Time in seconds after which idle keep-alive connections are closed
+        (default: :attr:`KEEP_ALIVE_TIMEOUT`, 0: close connection after each response)
+    :type keep_alive_timeout: float
+    """
+    KEEP_ALIVE_TIMEOUT = 15.0
+
+    def __init__(self, *args, **kw):
+        from concurrent.futures import ThreadPoolExecutor
+        workers = kw.pop("workers", None)
+        if workers is None:
+            workers = 4
+        self.keep_alive_timeout = kw.pop("keep_alive_timeout", self.KEEP_ALIVE_TIMEOUT)
+        # Idle keep-alive connections: socket -> (client address, time the connection expires)
+        self._idle = {}
+        self._idle_lock = threading.Lock()
+        self._watching = True
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._watcher = threading.Thread(target=self._watch_idle, name="KeepAliveWatcher")
+        self._watcher.daemon = True
+        self._watcher.start()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        super(ThreadedMicroscopeServer, self).__init__(*args, **kw)
+
+    def create_microscope(self, microscope_factory):
+        from .executor import MicroscopeExecutor, MicroscopeProxy
+        self.executor = MicroscopeExecutor("MicroscopeExecutor")
+        self.slow_executor = MicroscopeExecutor("MicroscopeSlowExecutor")
+        microscope = self.executor.call(microscope_factory)
+        return MicroscopeProxy(microscope, self.executor, self.slow_executor)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request_thread(self, request, client_address):
+        keep_alive = False
+        try:
+            handler = self.finish_request(request, client_address)
+            keep_alive = not handler.close_connection and self.keep_alive_timeout > 0
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if keep_alive:
+                self._add_idle(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+    def _add_idle(self, request, client_address):
+        with self._idle_lock:
+            if not self._watching:
+                self.shutdown_request(request)
+                return
+            self._idle[request] = (client_address, time.time() + self.keep_alive_timeout)
+        self._wakeup_send.send(b"\0")
+
+    def _watch_idle(self):
+        while True:
+            with self._idle_lock:
+                if not self._watching:
+                    return
+                idle = dict(self._idle)
+            timeout = max(0.0, min(expires for _, expires in idle.values()) - time.time()) if idle else None
+            try:
+                readable, _, _ = select.select([self._wakeup_recv] + list(idle.keys()), [], [], timeout)
+            except (select.error, socket.error, ValueError):
+                # Connection closed meanwhile by server_close
+                continue
+            if self._wakeup_recv in readable:
+                self._wakeup_recv.recv(4096)
+            now = time.time()
+            with self._idle_lock:
+                for request, (client_address, expires) in idle.items():
+                    if request not in self._idle:
+                        continue
+                    if request in readable:
+                        # Next request (or client closed connection)
+                        del self._idle[request]
+                        self._pool.submit(self.process_request_thread, request, client_address)
+                    elif expires <= now:
+                        del self._idle[request]
+                        self.shutdown_request(request)
+
+    def server_close(self):
+        super(ThreadedMicroscopeServer, self).server_close()
+        with self._idle_lock:
+            self._watching = False
+            for request in self._idle:
+                self.shutdown_request(request)
+            self._idle.clear()
+        self._wakeup_send.send(b"\0")
+        self._watcher.join()
+        self._wakeup_send.close()
+        self._wakeup_recv.close()
+        self._pool.shutdown(wait=True)
+        self.slow_executor.shutdown()
+        self.executor.shutdown()
+
 
 class NullMicroscopeServer(HTTPServer, object):
     """
@@ -348,11 +543,27 @@ def run_server(argv=None, microscope_factory=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", type=int, default=8080, help="Specify port on which the server is listening")
     parser.add_argument("--host", type=str, default='', help="Specify host address on which the the server is listening")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Number of worker threads for concurrent request handling, requires Python 3 "
+                             "(default: 0, sequential handling)")
+    parser.add_argument("--cache", action="store_true", help="Cache results of microscope getters")
+    parser.add_argument("--cache-ttl", type=float, default=0.0,
+                        help="Time-to-live in seconds for cached non-static properties (default: 0.0)")
+    parser.add_argument("--compress-level", type=int, default=5, choices=range(10), metavar="{0..9}",
+                        help="Compression level for compressed responses (default: 5, 0: no compression)")
     args = parser.parse_args(argv)
 
     try:
         # Create a web server and define the handler to manage the incoming request
-        server = MicroscopeServer((args.host, args.port), MicroscopeHandler, microscope_factory=microscope_factory)
+        if args.workers > 0:
+            server = ThreadedMicroscopeServer((args.host, args.port), MicroscopeHandler,
+                                              microscope_factory=microscope_factory, workers=args.workers,
+                                              cache=args.cache, cache_ttl=args.cache_ttl,
+                                              compress_level=args.compress_level)
+        else:
+            server = MicroscopeServer((args.host, args.port), MicroscopeHandler, microscope_factory=microscope_factory,
+                                      cache=args.cache, cache_ttl=args.cache_ttl,
+                                      compress_level=args.compress_level)
         print("Started httpserver on host '%s' port %d." % (args.host, args.port))
         print("Press Ctrl+C to stop server.")
         # Wait forever for incoming htto requests
@@ -360,7 +571,7 @@ def run_server(argv=None, microscope_factory=None):
 
     except KeyboardInterrupt:
         print('Ctrl+C received, shutting down the web server')
-        server.socket.close()
+        server.server_close()
 
     return 0
 
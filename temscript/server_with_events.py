@@ -11,7 +11,12 @@ import argparse
 
 import numpy as np
 import json
+import time
 from io import BytesIO
+from collections import deque
+import heapq
+import inspect
+import itertools
 import asyncio
 from aiohttp import web, WSMsgType
 from appdirs import user_log_dir
@@ -20,10 +25,208 @@ from appdirs import user_log_dir
 # from functools import partial
 from temscript import server_config
 from temscript import logger
+from temscript.array_transport import NDARRAY_CONTENT_TYPE, is_ndarray_dict, encode_ndarrays
+from temscript.executor import MicroscopeExecutor
+from temscript.endpoints import EndpointError, get_value, set_value, get_values
 
 # initialize logger
 log = logger.getLoggerForModule("TemscriptingServer")
 
+
+# Overflow policies for the outbound queues of websocket clients:
+# - "drop_oldest": drop the oldest queued message (sequenced clients only,
+#   legacy clients can't detect lost events, they use "coalesce" instead)
+# - "coalesce": merge all queued messages into one with the latest values
+# - "disconnect": close the connection
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+class WebsocketMessage:
+    """
+    An outbound websocket message (serialized once, shared by all
+    clients receiving it)
+    :param kind "changes" or "snapshot"
+    :param seq Sequence number of the (last) event
+    :param timestamp Timestamp of the (last) event
+    :param values dict with the changed values (resp. complete state)
+    :param sequenced Whether the message is for the sequenced protocol
+                (otherwise only the values are sent)
+    :param first_seq Sequence number of the first event merged into
+                the message (None: same as seq). Sent as "first_seq",
+                so clients don't mistake merged events for lost ones.
+    """
+    __slots__ = ("kind", "seq", "first_seq", "timestamp", "values", "text")
+
+    def __init__(self, kind, seq, timestamp, values, sequenced, first_seq=None):
+        self.kind = kind
+        self.seq = seq
+        self.first_seq = first_seq if first_seq is not None else seq
+        self.timestamp = timestamp
+        self.values = values
+        if sequenced:
+            message = {"seq": seq, "timestamp": timestamp, kind: values}
+            if kind == "changes" and self.first_seq != seq:
+                message["first_seq"] = self.first_seq
+            self.text = json.dumps(message)
+        else:
+            self.text = json.dumps(values)
+
+
+def _coalesce_messages(messages, sequenced):
+    """
+    Merge messages into one message with the latest values
+    """
+    kind = "changes"
+    values = dict()
+    first_seq = messages[0].first_seq
+    for message in messages:
+        if message.kind == "snapshot":
+            kind = "snapshot"
+            values = dict(message.values)
+        else:
+            values.update(message.values)
+    last = messages[-1]
+    return WebsocketMessage(kind, last.seq, last.timestamp, values, sequenced,
+                            first_seq if kind == "changes" else None)
+
+
+class WebsocketClient:
+    """
+    A websocket client connection of the server.
+    Messages are queued in a bounded outbound queue and sent by a
+    dedicated sender task, so slow clients don't delay other clients.
+    :param ws The websocket response of the connection
+    :type ws aiohttp.web.WebSocketResponse
+    :param sequenced Whether the client uses the sequenced protocol
+                (messages with sequence number and timestamp).
+                Legacy clients receive the bare change dicts.
+    :type sequenced bool
+    :param props Names of the properties the client subscribed to
+                (None: all properties)
+    :type props frozenset
+    :param queue_size Maximum number of queued messages
+    :type queue_size int
+    :param overflow Policy for a full queue (see OVERFLOW_POLICIES).
+                Legacy clients use "coalesce" instead of "drop_oldest".
+    :type overflow str
+    :param coalesce_window Time in seconds the sender waits after
+                a message was queued, all messages queued meanwhile are
+                merged into one message with the latest values (0: no waiting)
+    :type coalesce_window float
+    :param max_rate Maximal number of messages per second (None: unlimited).
+                Messages queued while waiting are merged as well.
+    :type max_rate float
+    """
+    def __init__(self, ws, sequenced=False, props=None,
+                 queue_size=100, overflow="coalesce",
+                 coalesce_window=0.0, max_rate=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        if overflow == "drop_oldest" and not sequenced:
+            # without sequence numbers dropped changes would go unnoticed
+            overflow = "coalesce"
+        self.ws = ws
+        self.sequenced = sequenced
+        self.props = props
+        self.overflow = overflow
+        self.coalesce_window = coalesce_window
+        self.max_rate = max_rate
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # sequence number of the last event sent to the client
+        self.last_seq = 0
+        # number of messages dropped (or merged) due to queue overflows
+        self.dropped = 0
+        self.closed = False
+        self._task = None
+
+    @property
+    def group(self):
+        """
+        Clients of the same group receive the same messages
+        """
+        return (self.sequenced, self.props)
+
+    def filter(self, values):
+        """
+        Return the entries of the dict 'values' the client subscribed to
+        """
+        if self.props is None:
+            return values
+        return dict((key, value) for key, value in values.items() if key in self.props)
+
+    def start(self):
+        """
+        Start sender task
+        """
+        self._task = asyncio.ensure_future(self._send_loop())
+
+    async def stop(self):
+        """
+        Stop sender task (pending messages are discarded)
+        """
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def send(self, message):
+        """
+        Queue message for sending (without waiting)
+        :param message: the WebsocketMessage
+        """
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+        if self.overflow == "disconnect":
+            log.warn("Outbound queue of websocket client full: closing connection")
+            self.closed = True
+            asyncio.ensure_future(self.ws.close())
+        elif self.overflow == "coalesce":
+            pending = []
+            while not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            pending.append(message)
+            self.dropped += len(pending) - 1
+            self.queue.put_nowait(_coalesce_messages(pending, self.sequenced))
+        else:
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.queue.put_nowait(message)
+
+    async def _send_loop(self):
+        loop = asyncio.get_event_loop()
+        min_interval = 1.0 / self.max_rate if self.max_rate else 0.0
+        next_send = loop.time()
+        try:
+            while True:
+                message = await self.queue.get()
+                delay = max(self.coalesce_window, next_send - loop.time())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    # merge the messages queued in the meantime
+                    pending = [message]
+                    while not self.queue.empty():
+                        pending.append(self.queue.get_nowait())
+                    if len(pending) > 1:
+                        message = _coalesce_messages(pending, self.sequenced)
+                await self.ws.send_str(message.text)
+                next_send = loop.time() + min_interval
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            log.warn("Sending to websocket client failed: %s" % exc)
+            self.closed = True
+            await self.ws.close()
+
+
 class MicroscopeServerWithEvents:
     """
     Implements the same HTTP server as server.py
@@ -34,7 +237,27 @@ class MicroscopeServerWithEvents:
     HTTP-URLs are supposed to follow the format
         http://127.0.0.1:7351/v1/...
     Websocket connections are initialized via the websocket URL
-        ws://127.0.0.1:7351/ws/
+        ws://127.0.0.1:7351/ws/v1
+    Clients connecting with
+        ws://127.0.0.1:7351/ws/v1?since=N
+    (or sending the message {"since": N}) use the sequenced protocol:
+    Each event is sent as {"seq": ..., "timestamp": ..., "changes": {...}}.
+    The events after sequence number N are resent from the event history,
+    if they are still available, otherwise the complete state is sent as
+    {"seq": ..., "timestamp": ..., "snapshot": {...}}.
+    Legacy clients receive the complete state and the change dicts only.
+    Clients can restrict the events to a set of properties by connecting with
+        ws://127.0.0.1:7351/ws/v1?props=beam_blanked&props=voltage
+    (or sending the message {"subscribe": ["beam_blanked", "voltage"]},
+    null subscribes to all properties). The subscription message only
+    affects the following events, combine it with "since" for a resync.
+    Each client has a bounded outbound queue, which is handled according
+    to the overflow policy, when the client can't keep up (the policy can
+    be chosen per client with ws://127.0.0.1:7351/ws/v1?overflow=disconnect).
+    Events following each other quickly can be merged per client into one
+    message with the latest values (coalescing window, maximal message
+    rate, per client: ?coalesce=0.2&max_rate=5). Merged events are sent
+    with the additional key "first_seq" in the sequenced protocol.
     :param host IP the webserver is running under. Default is "0.0.0.0"
                 (run on all interfaces)
     :type host str
@@ -43,18 +266,69 @@ class MicroscopeServerWithEvents:
     :param microscope the Microscope to use (either NullMicroscope()
                 or Microscope())
     :type microscope Microscope
+    :param executor Executor running the microscope calls of HTTP requests
+                (optional, by default a dedicated executor is created)
+    :type executor MicroscopeExecutor
+    :param slow_executor Executor running long microscope calls like
+                "acquire" (optional, by default a dedicated executor is created)
+    :type slow_executor MicroscopeExecutor
+    :param history_size Number of events kept for resynchronization
+                of reconnecting clients. Default is 1000.
+    :type history_size int
+    :param client_queue_size Maximum number of messages queued for
+                a websocket client. Default is 100.
+    :type client_queue_size int
+    :param overflow_policy Default policy for full client queues
+                ("drop_oldest", "coalesce" or "disconnect").
+                Default is "coalesce".
+    :type overflow_policy str
+    :param coalesce_window Default coalescing window for websocket
+                clients in seconds. Default is 0 (no coalescing).
+    :type coalesce_window float
+    :param max_event_rate Default maximal number of messages per
+                second for websocket clients. Default is None (unlimited).
+    :type max_event_rate float
     """
 
-    def __init__(self, microscope, host="0.0.0.0", port=7351):
+    # GET/PUT commands executed on the slow executor
+    SLOW_GET_COMMANDS = frozenset(("acquire",))
+    SLOW_PUT_COMMANDS = frozenset(("normalize", "stage_position"))
+
+    # Endpoints not served (the acquisition stream can't be read from this server)
+    UNSUPPORTED_COMMANDS = frozenset(("stream",))
+
+    def __init__(self, microscope, host="0.0.0.0", port=7351,
+                 executor=None, slow_executor=None, history_size=1000,
+                 client_queue_size=100, overflow_policy="coalesce",
+                 coalesce_window=0.0, max_event_rate=None):
         self.host = host
         self.port = port
         self.microscope = microscope
         log.info("Configuring web server for host=%s, port=%s" % (self.host, self.port))
 
+        # microscope calls are executed on worker threads,
+        # so that the event loop keeps running during long calls
+        if executor is None:
+            executor = MicroscopeExecutor("MicroscopeExecutor")
+        if slow_executor is None:
+            slow_executor = MicroscopeExecutor("MicroscopeSlowExecutor")
+        self.executor = executor
+        self.slow_executor = slow_executor
+
         # a dict for storing polling results
         self.microscope_state = dict()
         self.microscope_state_lock = asyncio.Lock()
-        # set of client references
+        # sequence number of the last event and history of the
+        # last events as (seq, timestamp, changes) tuples
+        self.event_seq = 0
+        self.event_history = deque(maxlen=history_size)
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow_policy)
+        self.client_queue_size = client_queue_size
+        self.overflow_policy = overflow_policy
+        self.coalesce_window = coalesce_window
+        self.max_event_rate = max_event_rate
+        # set of clients (WebsocketClient instances)
         self.clients = set()
         self.clients_lock = asyncio.Lock()
 
@@ -67,13 +341,26 @@ class MicroscopeServerWithEvents:
         """
         command = request.match_info['name']
         parameter = request.rel_url.query
+        accept_type = [x.split(';', 1)[0].strip() for x in request.headers.get("Accept", "").split(",")]
         try:
-            response = self.do_GET_V1(command, parameter)
+            executor = self.slow_executor if command in self.SLOW_GET_COMMANDS else self.executor
+            response = await asyncio.wrap_future(
+                executor.submit(self.do_GET_V1, command, parameter))
             if response is None:
                 # unsupported command: send status 204
                 return web.Response(body="Unsupported command {}"
                                     .format(command),
                                     status=204)
+            elif NDARRAY_CONTENT_TYPE in accept_type and is_ndarray_dict(response):
+                # send arrays directly from their buffers
+                chunks = encode_ndarrays(response)
+                stream_response = web.StreamResponse(headers={"Content-Type": NDARRAY_CONTENT_TYPE})
+                stream_response.content_length = sum(len(chunk) for chunk in chunks)
+                await stream_response.prepare(request)
+                for chunk in chunks:
+                    await stream_response.write(chunk)
+                await stream_response.write_eof()
+                return stream_response
             else:
                 # send JSON response and (default) status 200
                 encoded_response = ArrayJSONEncoder()\
@@ -82,10 +369,10 @@ class MicroscopeServerWithEvents:
                                     content_type="application/json")
         except MicroscopeException as e:
             # regular exception due to misconfigurations etc.: send error status 404
-            return web.Response(body=e, status=404)
+            return web.Response(text=str(e), status=404)
         except Exception as e:
             # any exception beyond that: send error status 500
-            return web.Response(body=e, status=500)
+            return web.Response(text=str(e), status=500)
 
     def do_GET_V1(self, command, parameter):
         """
@@ -94,111 +381,14 @@ class MicroscopeServerWithEvents:
         :param parameter: optional query parameter ,
                           see "acquire" command
         """
-        # Check for known endpoints
-        response = None
-        if command == "family":
-            response = self.microscope.get_family()
-        elif command == "microscope_id":
-            response = self.microscope.get_microscope_id()
-        elif command == "version":
-            response = self.microscope.get_version()
-        elif command == "voltage":
-            response = self.microscope.get_voltage()
-        elif command == "vacuum":
-            response = self.microscope.get_vacuum()
-        elif command == "stage_holder":
-            response = self.microscope.get_stage_holder()
-        elif command == "stage_status":
-            response = self.microscope.get_stage_status()
-        elif command == "stage_position":
-            response = self.microscope.get_stage_position()
-        elif command == "stage_limits":
-            response = self.microscope.get_stage_limits()
-        elif command == "detectors":
-            response = self.microscope.get_detectors()
-        elif command == "image_shift":
-            response = self.microscope.get_image_shift()
-        elif command == "beam_shift":
-            response = self.microscope.get_beam_shift()
-        elif command == "beam_tilt":
-            response = self.microscope.get_beam_tilt()
-        elif command == "instrument_mode":
-            response = self.microscope.get_instrument_mode()
-        elif command == "instrument_mode_string":
-            response = self.microscope.get_instrument_mode_string()
-        elif command == "df_mode":
-            response = self.microscope.get_df_mode()
-        elif command == "df_mode_string":
-            response = self.microscope.get_df_mode_string()
-        elif command == "projection_sub_mode":
-            response = self.microscope.get_projection_sub_mode()
-        elif command == "projection_mode":
-            response = self.microscope.get_projection_mode()
-        elif command == "projection_mode_string":
-            response = self.microscope.get_projection_mode_string()
-        elif command == "projection_mode_type_string":
-            response = self.microscope.get_projection_mode_type_string()
-        elif command == "lens_program":
-            response = self.microscope.get_lens_program()
-        elif command == "lens_program_string":
-            response = self.microscope.get_lens_program_string()
-        elif command == "illumination_mode":
-            response = self.microscope.get_illumination_mode()
-        elif command == "illumination_mode_string":
-            response = self.microscope.get_illumination_mode_string()
-        elif command == "illuminated_area":
-            response = self.microscope.get_illuminated_area()
-        elif command == "condenser_mode":
-            response = self.microscope.get_condenser_mode()
-        elif command == "condenser_mode_string":
-            response = self.microscope.get_condenser_mode_string()
-        elif command == "convergence_angle":
-            response = self.microscope.get_convergence_angle()
-        elif command == "spot_size_index":
-            response = self.microscope.get_spot_size_index()
-        elif command == "magnification_index":
-            response = self.microscope.get_magnification_index()
-        elif command == "stem_magnification":
-            response = self.microscope.get_stem_magnification()
-        elif command == "indicated_camera_length":
-            response = self.microscope.get_indicated_camera_length()
-        elif command == "indicated_magnification":
-            response = self.microscope.get_indicated_magnification()
-        elif command == "defocus":
-            response = self.microscope.get_defocus()
-        elif command == "probe_defocus":
-            response = self.microscope.get_probe_defocus()
-        elif command == "objective_excitation":
-            response = self.microscope.get_objective_excitation()
-        elif command == "intensity":
-            response = self.microscope.get_intensity()
-        elif command == "objective_stigmator":
-            response = self.microscope.get_objective_stigmator()
-        elif command == "condenser_stigmator":
-            response = self.microscope.get_condenser_stigmator()
-        elif command == "diffraction_shift":
-            response = self.microscope.get_diffraction_shift()
-        elif command == "optics_state":
-            response = self.microscope.get_optics_state()
-        elif command == "beam_blanked":
-            response = self.microscope.get_beam_blanked()
-        elif command == "voltage_offset":
-            # HT offset supported by StdScript 7.10
-            response = self.microscope.get_voltage_offset()
-        elif command.startswith("detector_param/"):
-            try:
-                name = command[15:]
-                response = self.microscope.get_detector_param(name)
-            except KeyError:
-                raise MicroscopeException('Unknown detector: %s' % command)
-        elif command == "acquire":
-            try:
-                detectors = parameter["detectors"]
-            except KeyError:
-                raise MicroscopeException('No detectors: %s' % command)
-            response = self.microscope.acquire(*detectors)
-        else:
-            raise MicroscopeException('Unknown endpoint: %s' % command)
+        if parameter is not None:
+            parameter = dict((key, parameter.getall(key)) for key in set(parameter.keys()))
+        if command in self.UNSUPPORTED_COMMANDS:
+            raise MicroscopeException('Unsupported endpoint: %s' % command)
+        try:
+            response = get_value(self.microscope, command, parameter)
+        except EndpointError as exc:
+            raise MicroscopeException(str(exc))
         # log.debug('Returning response %s for command %s...' % (response, command))
         return response
 
@@ -217,7 +407,9 @@ class MicroscopeServerWithEvents:
             # get JSON content
             text_content = await request.text()
             json_content = json.loads(text_content)
-            response = self.do_PUT_V1(command, json_content)
+            executor = self.slow_executor if command in self.SLOW_PUT_COMMANDS else self.executor
+            response = await asyncio.wrap_future(
+                executor.submit(self.do_PUT_V1, command, json_content))
             if response is None:
                 # unsupported command: send status 204
                 return web.Response(body="Unsupported command {}"
@@ -231,10 +423,10 @@ class MicroscopeServerWithEvents:
                                     content_type="application/json")
         except MicroscopeException as e:
             # regular exception due to misconfigurations etc.: send error status 404
-            return web.Response(body=e, status=404)
+            return web.Response(text=str(e), status=404)
         except Exception as e:
             # any exception beyond that: send error status 500
-            return web.Response(body=e, status=500)
+            return web.Response(text=str(e), status=500)
 
     def do_PUT_V1(self, command, json_content):
         """
@@ -242,64 +434,55 @@ class MicroscopeServerWithEvents:
         :param command: The PUT command to execute
         :param json_content: the content/value to set
         """
-        response = None
-        # Check for known endpoints
-        if command == "stage_position":
-            method = json_content.get("method", "GO")
-            pos = dict((k, json_content[k]) for k in json_content.keys() if k in self.microscope.STAGE_AXES)
-            try:
-                pos['speed'] = json_content['speed']
-            except KeyError:
-                pass
-            self.microscope.set_stage_position(pos, method=method)
-        elif command == "image_shift":
-            self.microscope.set_image_shift(json_content)
-        elif command == "beam_shift":
-            self.microscope.set_beam_shift(json_content)
-        elif command == "beam_tilt":
-            self.microscope.set_beam_tilt(json_content)
-        elif command == "df_mode":
-            self.microscope.set_df_mode(json_content)
-        elif command == "illuminated_area":
-            self.microscope.set_illuminated_area(json_content)
-        elif command == "projection_mode":
-            self.microscope.set_projection_mode(json_content)
-        elif command == "magnification_index":
-            self.microscope.set_magnification_index(json_content)
-        elif command == "stem_magnification":
-            self.microscope.set_stem_magnification(json_content)
-        elif command == "defocus":
-            self.microscope.set_defocus(json_content)
-        elif command == "probe_defocus":
-            self.microscope.set_probe_defocus(json_content)
-        elif command == "intensity":
-            self.microscope.set_intensity(json_content)
-        elif command == "diffraction_shift":
-            self.microscope.set_diffraction_shift(json_content)
-        elif command == "objective_stigmator":
-            self.microscope.set_objective_stigmator(json_content)
-        elif command == "condenser_stigmator":
-            self.microscope.set_condenser_stigmator(json_content)
-        elif command == "beam_blanked":
-            self.microscope.set_beam_blanked(json_content)
-        elif command == "voltage_offset":
-            # HT offset supported by StdScript 7.10
-            self.microscope.set_voltage_offset(json_content)
-        elif command.startswith("detector_param/"):
-            try:
-                name = command[15:]
-                response = self.microscope.set_detector_param(name, json_content)
-            except KeyError:
-                raise MicroscopeException('Unknown detector: %s' % command)
-        elif command == "normalize":
-            mode = json_content
-            try:
-                self.microscope.normalize(mode)
-            except ValueError:
-                raise MicroscopeException('Unknown mode: %s' % mode)
-        else:
+        if command in self.UNSUPPORTED_COMMANDS:
+            raise MicroscopeException('Unsupported endpoint: %s' % command)
+        try:
+            return set_value(self.microscope, command, json_content)
+        except EndpointError as exc:
+            raise MicroscopeException(str(exc))
+
+    async def http_post_handler_v1(self, request):
+        """
+        aiohttp handler fur POST request for V1
+        (only "batch" requests with a list of GET commands)
+        :param request: the aiohttp POST request
+        :return:  the aiohttp response
+        """
+        command = request.match_info['name']
+        content_length = request.headers['content-length']
+        if content_length is not None:
+            if int(content_length) > 4096:
+                raise ValueError("Too much content...")
+        try:
+            # get JSON content
+            text_content = await request.text()
+            json_content = json.loads(text_content)
+            response = await asyncio.wrap_future(
+                self.executor.submit(self.do_POST_V1, command, json_content))
+            # send JSON response and (default) status 200
+            encoded_response = ArrayJSONEncoder()\
+                .encode(response).encode("utf-8")
+            return web.Response(body=encoded_response,
+                                content_type="application/json")
+        except MicroscopeException as e:
+            # regular exception due to misconfigurations etc.: send error status 404
+            return web.Response(text=str(e), status=404)
+        except Exception as e:
+            # any exception beyond that: send error status 500
+            return web.Response(text=str(e), status=500)
+
+    def do_POST_V1(self, command, json_content):
+        """
+        Handler for HTTP V1 POST requests
+        :param command: The POST command to execute (only "batch")
+        :param json_content: list of GET commands
+        """
+        if command != "batch":
             raise MicroscopeException('Unknown endpoint: %s' % command)
-        return response
+        try:
+            return get_values(self.microscope, json_content)
+        except EndpointError as exc:
+            raise MicroscopeException(str(exc))
 
     async def websocket_handler_v1(self, request):
         """
@@ -314,13 +497,33 @@ class MicroscopeServerWithEvents:
         ws = web.WebSocketResponse()
         remote_ip = request.remote
         log.info('Websocket handler for IP %s created.' % remote_ip)
+        since = request.rel_url.query.get("since")
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            return web.Response(body="Invalid sequence number: %s" % since, status=404)
+        props = request.rel_url.query.getall("props", None)
+        overflow = request.rel_url.query.get("overflow", self.overflow_policy)
+        if overflow not in OVERFLOW_POLICIES:
+            return web.Response(body="Unknown overflow policy: %s" % overflow, status=404)
+        try:
+            coalesce_window = float(request.rel_url.query.get("coalesce", self.coalesce_window))
+            max_rate = request.rel_url.query.get("max_rate", self.max_event_rate)
+            max_rate = float(max_rate) if max_rate is not None else None
+        except ValueError:
+            return web.Response(body="Invalid coalescing parameters", status=404)
         await ws.prepare(request)
         # add client to set
-        await self.add_websocket_client(ws)
+        client = await self.add_websocket_client(ws, since, props, overflow,
+                                                 coalesce_window, max_rate)
 
         try:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
+                    message = _parse_client_message(msg.data)
+                    if message is not None:
+                        await self.handle_client_message(client, message)
+                        continue
                     if msg.data != 'close':
                         log.warn('websocket connection received unsupported text message: "%s"' % msg.data)
                     await ws.close()
@@ -331,7 +534,6 @@ class MicroscopeServerWithEvents:
                     pass
                     # log.debug('websocket connection received PONG')
                 elif msg.type == WSMsgType.ERROR:
-                    await self.remove_websocket_client(ws)
                     log.exception('websocket connection closed with exception %s' %
                           ws.exception())
                     await ws.close()
@@ -341,51 +543,146 @@ class MicroscopeServerWithEvents:
         finally:
             log.info('Websocket client session closed for IP %s' % remote_ip)
             await ws.close()
-            await self.remove_websocket_client(ws)
+            await self.remove_websocket_client(client)
 
         return ws
 
-    async def add_websocket_client(self, ws):
-        async with self.clients_lock:
-            # log.debug('number of clients before adding new client: %s ' %
-            #       len(self.clients))
-            self.clients.add(ws)
-            log.debug('number of clients after adding new client: %s ' %
-                  len(self.clients))
+    async def add_websocket_client(self, ws, since=None, props=None, overflow=None,
+                                   coalesce_window=None, max_rate=None):
+        """
+        Add client and send the current state
+        :param ws: the websocket response
+        :param since: Sequence number of the last event received by the
+                client (sequenced protocol) or None (legacy protocol)
+        :param props: List of the properties the client subscribed to
+                (None: all properties)
+        :param overflow: Overflow policy of the outbound queue
+                (None: policy of the server)
+        :param coalesce_window: Coalescing window in seconds
+                (None: coalescing window of the server)
+        :param max_rate: Maximal number of messages per second
+                (None: maximal event rate of the server)
+        :return: the WebsocketClient instance
+        """
+        client = WebsocketClient(ws, sequenced=since is not None,
+                                 props=frozenset(props) if props is not None else None,
+                                 queue_size=self.client_queue_size,
+                                 overflow=overflow if overflow is not None else self.overflow_policy,
+                                 coalesce_window=(coalesce_window if coalesce_window is not None
+                                                  else self.coalesce_window),
+                                 max_rate=max_rate if max_rate is not None else self.max_event_rate)
+        client.start()
         async with self.microscope_state_lock:
-            if self.microscope_state:
-                log.info('Sending microscope state to new client: %s :' %
-                      self.microscope_state)
-                await ws.send_json(self.microscope_state)
+            async with self.clients_lock:
+                self.clients.add(client)
+                log.debug('number of clients after adding new client: %s ' %
+                      len(self.clients))
+            state = client.filter(self.microscope_state)
+            if client.sequenced:
+                self._resync(client, since)
+            elif state:
+                log.info('Sending microscope state to new client: %s :' % state)
+                client.last_seq = self.event_seq
+                client.send(WebsocketMessage("snapshot", self.event_seq, time.time(), dict(state), False))
+            else:
+                client.last_seq = self.event_seq
+        return client
 
-    async def remove_websocket_client(self, ws):
+    async def remove_websocket_client(self, client):
         async with self.clients_lock:
-            # log.debug("number of clients before removing client: %s " %
-            #       len(self.clients))
-            self.clients.remove(ws)
+            self.clients.discard(client)
             log.debug("number of clients after removing client: %s " %
                   len(self.clients))
+        await client.stop()
+
+    async def handle_client_message(self, client, message):
+        """
+        Handle JSON message of a websocket client:
+        {"subscribe": [...]} changes the subscribed properties,
+        {"since": N} requests a resynchronization
+        :param message: the decoded message (dict)
+        """
+        if "subscribe" in message:
+            props = message["subscribe"]
+            async with self.clients_lock:
+                client.props = frozenset(props) if props is not None else None
+        if "since" in message:
+            await self.resync_websocket_client(client, int(message["since"]))
+
+    async def resync_websocket_client(self, client, since):
+        """
+        Send the events after sequence number 'since' (or the complete
+        state, if they are no longer available) to the client.
+        The client is switched to the sequenced protocol.
+        """
+        client.sequenced = True
+        async with self.microscope_state_lock:
+            self._resync(client, since)
 
-    async def broadcast_to_websocket_clients(self, obj):
+    def _resync(self, client, since):
+        # (called with microscope_state_lock held)
+        history = self.event_history
+        replay = None
+        if 0 < since <= self.event_seq and (since == self.event_seq or
+                                            (history and history[0][0] <= since + 1)):
+            replay = []
+            for seq, timestamp, changes in history:
+                changes = client.filter(changes)
+                if seq > since and changes:
+                    replay.append(WebsocketMessage("changes", seq, timestamp, changes, True))
+            if len(replay) > client.queue.maxsize > 0:
+                # a snapshot is cheaper than overflowing the queue
+                replay = None
+        if replay is None:
+            replay = [WebsocketMessage("snapshot", self.event_seq, time.time(),
+                                       dict(client.filter(self.microscope_state)), True)]
+        for message in replay:
+            client.send(message)
+        client.last_seq = self.event_seq
+
+    async def broadcast_to_websocket_clients(self, event):
         """
-        Converts obj to JSON string and sends the string to all connected websocket clients.
-        :param obj: JSON-serializable object
+        Queues an event for all connected websocket clients (subscribed to
+        the changed properties). The message is serialized once for each
+        group of clients with the same protocol and subscription.
+        :param event: Tuple (seq, timestamp, changes)
         :return:
         """
         async with self.clients_lock:
-            for ws in self.clients:
-                # send object as JSON to websocket client
-                await ws.send_json(obj)
+            messages = dict()
+            for client in self.clients:
+                if client.last_seq >= event[0]:
+                    # already sent during (re)synchronization
+                    continue
+                client.last_seq = event[0]
+                group = client.group
+                if group not in messages:
+                    changes = client.filter(event[2])
+                    if changes:
+                        messages[group] = WebsocketMessage("changes", event[0], event[1], changes,
+                                                           client.sequenced)
+                    else:
+                        messages[group] = None
+                if messages[group] is not None:
+                    client.send(messages[group])
 
-    async def change_microscope_state(self, new_values):
+    async def change_microscope_state(self, new_values, tolerances=None):
         """
         Change a set of entries in the microscope state
         and notify websocket clients in case of changes
         :param changes: A dict with command-result values
         :type changes: dict
-        :return:
+        :param tolerances: A dict with (atol, rtol) tuples indexed by
+                command. Numeric values (also tuples, arrays and dicts of
+                numbers) only count as changed, if they differ by more than
+                atol + rtol * abs(last reported value)
+        :type tolerances: dict
+        :return: A dict with the changed command-result values
         """
         changes = dict()
+        event = None
+        if tolerances is None:
+            tolerances = dict()
         async with self.microscope_state_lock:
             for command in new_values:
                 new_result = new_values[command]
@@ -394,15 +691,31 @@ class MicroscopeServerWithEvents:
                     changes[command] = new_result
                     # update value
                     self.microscope_state[command] = new_result
-                elif new_result != self.microscope_state[command]:
+                elif _values_differ(new_result, self.microscope_state[command],
+                                    tolerances.get(command)):
                     # results differ: add new result to changes
                     changes[command] = new_result
                     # update value
                     self.microscope_state[command] = new_result
+            if changes:
+                # record event in history
+                self.event_seq += 1
+                event = (self.event_seq, time.time(), changes)
+                self.event_history.append(event)
         if len(changes) > 0:
             log.info("microscope state changed: %s" % changes)
-        if changes:
-            await self.broadcast_to_websocket_clients(changes)
+        if event is not None:
+            await self.broadcast_to_websocket_clients(event)
+        return changes
+
+    @property
+    def queue_depth(self):
+        """
+        Number of HTTP requests waiting for execution
+        :return: dict with queue depth of the regular and the slow executor
+        """
+        return {"microscope": self.executor.queue_depth,
+                "slow": self.slow_executor.queue_depth}
 
     def reset_microscope_state(self):
         self.microscope_state = dict()
@@ -412,10 +725,12 @@ class MicroscopeServerWithEvents:
         app = web.Application()
         # add routes for
         # - HTTP-GET/PUT, e.g. http://127.0.0.1:7351/v1/projection_mode
+        # - HTTP-POST for batch requests: http://127.0.0.1:7351/v1/batch
         # - websocket connection ws://127.0.0.1:7351/ws/v1
         app.add_routes([web.get('/ws/v1', self.websocket_handler_v1),  #
                         web.get(r'/v1/{name:.+}', self.http_get_handler_v1),
                         web.put(r'/v1/{name:.+}', self.http_put_handler_v1),
+                        web.post(r'/v1/{name:.+}', self.http_post_handler_v1),
                         ])
 
         # set up aiohttp - like run_app, but non-blocking, 
@@ -467,6 +782,61 @@ class ArrayJSONEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _values_differ(new, old, tolerance=None):
+    """
+    Compare polled values
+    :param new: the new value
+    :param old: the last reported value
+    :param tolerance: tuple (atol, rtol) for numeric values
+            (scalars, tuples, arrays or dicts of numbers)
+            or None for exact comparison
+    """
+    if tolerance is None:
+        return new != old
+    atol, rtol = tolerance
+    if isinstance(new, dict) and isinstance(old, dict):
+        if new.keys() != old.keys():
+            return True
+        keys = sorted(new.keys())
+        new = [new[key] for key in keys]
+        old = [old[key] for key in keys]
+    try:
+        new_array = np.asarray(new, dtype=float)
+        old_array = np.asarray(old, dtype=float)
+    except (TypeError, ValueError):
+        return new != old
+    if new_array.shape != old_array.shape:
+        return True
+    return not np.all(np.abs(new_array - old_array) <= atol + rtol * np.abs(old_array))
+
+
+def _parse_client_message(text):
+    """
+    Parse JSON message of a websocket client ({"since": N} and/or
+    {"subscribe": [...]})
+    :return: the message dict or None if the text is no such message
+    """
+    try:
+        message = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(message, dict):
+        return None
+    try:
+        if "since" in message:
+            int(message["since"])
+        if "subscribe" in message:
+            props = message["subscribe"]
+            if props is not None and (isinstance(props, str) or
+                                      not all(isinstance(prop, str) for prop in props)):
+                return None
+    except (ValueError, TypeError):
+        return None
+    if "since" not in message and "subscribe" not in message:
+        return None
+    return message
+
+
 def _gzipencode(content):
     """GZIP encode bytes object"""
     import gzip
@@ -485,30 +855,113 @@ def _parse_enum(type, item):
         return type(item)
 
 
+class PollingEntry:
+    """
+    Polling configuration of a property.
+    Created from the values of the polling configuration, which are either
+    tuples (cast, scale[, interval[, atol[, rtol]]]) or dicts with the keys
+    "cast", "scale" and optionally "interval", "atol", "rtol" and
+    "max_interval".
+    :param cast The conversion method (e.g. float)
+    :param scale The scaling factor (for int/float-types)
+    :param interval The polling interval in seconds
+                (None: sleeping time of the publisher)
+    :param atol Absolute tolerance for change detection
+    :param rtol Relative tolerance for change detection
+                (relative to the last reported value)
+    :param max_interval The maximal polling interval in adaptive mode
+                (None: determined by the publisher)
+    """
+    def __init__(self, cast, scale=1, interval=None, atol=0.0, rtol=0.0,
+                 max_interval=None):
+        self.cast = cast
+        self.scale = scale
+        self.interval = interval
+        self.atol = atol
+        self.rtol = rtol
+        self.max_interval = max_interval
+
+    @property
+    def tolerance(self):
+        """
+        Tuple (atol, rtol) or None, if every change is reported
+        """
+        if self.atol or self.rtol:
+            return (self.atol, self.rtol)
+        return None
+
+    @classmethod
+    def from_config(cls, value):
+        if isinstance(value, PollingEntry):
+            return value
+        if isinstance(value, dict):
+            return cls(**value)
+        return cls(*value)
+
+
 class MicroscopeEventPublisher:
     """
     Periodically polls the microscope for a
     number of changes and forwards the result
     to the microscope state.
+    The microscope is polled on the executor thread of
+    the server, so the event loop is not blocked and the
+    COM calls of polling and HTTP requests are serialized.
+    Each property is polled with its own interval. Properties
+    due at the same time are polled together.
+    In adaptive mode, the interval of a property is increased
+    (by the factor 'backoff') each time no change was detected,
+    up to the maximal interval. After a change the property
+    is polled with its configured interval again.
+    The attribute 'polling_func' is the coroutine function doing
+    the polling (default: check_for_microscope_changes). It is
+    called with the list of properties due and returns the dict
+    of changed values (None: no changes). Legacy polling
+    functions without arguments are still supported, they are
+    called without arguments (and poll all properties).
     :param microscope_server: The server instance
-    :param sleep_time: The sleeping time between
-            polling calls in seconds.
+    :param sleep_time: The default polling interval in seconds
     :param polling_config: A configuration dict of
             methods and return types to poll.
             value is a tuple consisting of a conversion method
-            (e.g. "float()") and a scaling factor
-            (for int/float-types)
+            (e.g. "float()"), a scaling factor
+            (for int/float-types) and optionally the polling
+            interval in seconds (see PollingEntry)
+    :param executor: The executor running the polling calls
+            (optional, by default the executor of the server)
+    :type executor MicroscopeExecutor
+    :param adaptive: Whether to adapt the polling intervals (default: False)
+    :type adaptive bool
+    :param backoff: Factor the interval is increased with in adaptive mode (default: 1.5)
+    :type backoff float
+    :param max_interval_factor: Maximal interval in adaptive mode
+            relative to the configured interval (default: 10)
+    :type max_interval_factor float
     """
     def __init__(self, microscope_server,
-                 sleep_time, polling_config):
+                 sleep_time, polling_config, executor=None,
+                 adaptive=False, backoff=1.5, max_interval_factor=10):
         self.microscope_server = microscope_server
         self.sleep_time = sleep_time
-        self.polling_config = polling_config
+        self.polling_config = dict((name, PollingEntry.from_config(value))
+                                   for name, value in polling_config.items())
+        # tolerances for change detection indexed by property
+        self.tolerances = dict((name, entry.tolerance)
+                               for name, entry in self.polling_config.items()
+                               if entry.tolerance is not None)
+        if executor is None:
+            executor = microscope_server.executor
+        self.executor = executor
+        self.adaptive = adaptive
+        self.backoff = backoff
+        self.max_interval_factor = max_interval_factor
 
         # the microscope state representation
         self.microscope_state = dict()
-        # the method used for polling periodically
+        # the method used for polling the properties due
         self.polling_func = self.check_for_microscope_changes
+        # current polling intervals indexed by property
+        self.intervals = dict()
         self.is_started = False
         self._task = None
 
@@ -531,41 +984,122 @@ class MicroscopeEventPublisher:
             # Stop task and await it stopped:
             self._task.cancel()
 
+    def base_interval(self, name):
+        interval = self.polling_config[name].interval
+        return interval if interval is not None else self.sleep_time
+
+    def max_interval(self, name):
+        max_interval = self.polling_config[name].max_interval
+        if max_interval is not None:
+            return max_interval
+        return self.base_interval(name) * self.max_interval_factor
+
+    def next_interval(self, name, changed):
+        """
+        Update and return polling interval of a property
+        :param name: the property
+        :param changed: whether a change was detected by the last poll
+        """
+        if not self.adaptive or changed:
+            interval = self.base_interval(name)
+        else:
+            interval = min(self.intervals.get(name, self.base_interval(name)) * self.backoff,
+                           self.max_interval(name))
+        self.intervals[name] = interval
+        return interval
+
     async def _run(self):
-        log.info("Starting to poll for Temscripting changes with a polling time of %ss..." %
+        log.info("Starting to poll for Temscripting changes with a default polling time of %ss..." %
             self.sleep_time)
-        while True:
-            # sleep as configured for the instance
-            await asyncio.sleep(self.sleep_time)
+        loop = asyncio.get_event_loop()
+        # scheduler: heap of (due time, counter, property) tuples
+        schedule = []
+        counter = itertools.count()
+        now = loop.time()
+        for name in self.polling_config:
+            self.intervals[name] = self.base_interval(name)
+            heapq.heappush(schedule, (now + self.intervals[name], next(counter), name))
+        while schedule:
+            # sleep until the next property is due
+            delay = schedule[0][0] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # collect all properties due (within a small tolerance)
+            now = loop.time()
+            names = []
+            while schedule and schedule[0][0] <= now + 1e-3:
+                names.append(heapq.heappop(schedule)[2])
             # call polling function
-            await self.polling_func()
+            changes = await self._call_polling_func(names)
+            if changes is None:
+                changes = dict()
+            now = loop.time()
+            for name in names:
+                interval = self.next_interval(name, name in changes)
+                heapq.heappush(schedule, (now + interval, next(counter), name))
 
-    async def check_for_microscope_changes(self):
+    def _call_polling_func(self, names):
+        try:
+            parameters = inspect.signature(self.polling_func).parameters
+        except (TypeError, ValueError):
+            parameters = None
+        if parameters is not None and not parameters:
+            # legacy polling function without arguments
+            return self.polling_func()
+        return self.polling_func(names)
+
+    async def check_for_microscope_changes(self, names=None):
+        """
+        Poll properties and forward results to the microscope state
+        :param names: the properties to poll (None: all properties)
+        :return: dict with the changed values
+        """
         #log.debug("checking for microscope changes...")
+        if names is None:
+            names = list(self.polling_config.keys())
         try:
-            changed = {}
+            # poll on executor thread and hand results back to the event loop
+            # (one property per job, so HTTP requests queued on the same
+            # executor in the meantime only wait for a single property)
             all_results = dict()
-            for get_command in self.polling_config:
-                try:
-                    # execute get command
-                    # (here: imply parameterless command)
-                    result_raw = self.microscope_server.do_GET_V1(get_command,
-                                                              None)
-                    #log.debug("found %s=%s..." %
-                    #      (get_command, result_raw))
-                    casting_func = self.polling_config[get_command][0]
-                    result = casting_func(result_raw)
-                    # log.debug("Adding %s=%s to results..." %
-                    #        (get_command, result))
-                    all_results[get_command] = result
-                except Exception as exc:
-                    log.exception("TEMScripting method '{}' failed "
-                        "while polling: %s %s" % (get_command, exc))
-            await self.microscope_server.change_microscope_state(all_results)
+            for name in names:
+                all_results.update(await asyncio.wrap_future(
+                    self.executor.submit(self.poll_microscope, [name])))
+            return await self.microscope_server.change_microscope_state(
+                all_results, self.tolerances)
 
         except Exception as exc:
             #traceback.print_exc()
             log.exception("Polling failed: %s" % exc)
+            return dict()
+
+    def poll_microscope(self, names=None):
+        """
+        Execute configured GET commands
+        (called on the executor thread)
+        :param names: the commands to execute (None: all commands)
+        :return: dict with command-result values
+        """
+        if names is None:
+            names = list(self.polling_config.keys())
+        all_results = dict()
+        for get_command in names:
+            try:
+                # execute get command
+                # (here: imply parameterless command)
+                result_raw = self.microscope_server.do_GET_V1(get_command,
+                                                          None)
+                #log.debug("found %s=%s..." %
+                #      (get_command, result_raw))
+                casting_func = self.polling_config[get_command].cast
+                result = casting_func(result_raw)
+                # log.debug("Adding %s=%s to results..." %
+                #        (get_command, result))
+                all_results[get_command] = result
+            except Exception as exc:
+                log.exception("TEMScripting method '{}' failed "
+                    "while polling: %s %s" % (get_command, exc))
+        return all_results
 
 def configure_server():
     """
@@ -670,7 +1204,9 @@ if __name__ == '__main__':
     # during one polling event via the web server.
     # value is a tuple consisting of a conversion method
     # (e.g. "float()") and a scaling factor (for int/float)
-    # for the result of the method
+    # for the result of the method and optionally the
+    # polling interval in seconds (default: polling sleep)
+    # and the absolute and relative tolerance for changes
     tem_scripting_method_config = {
         # for meta data key 'condenser.mode'
         "instrument_mode_string": (str, 1),     # "TEM"/"STEM"
@@ -679,14 +1215,14 @@ if __name__ == '__main__':
         "df_mode_string": (str, 1),             # e.g., "CARTESIAN", "OFF"
         "spot_size_index": (int, 1),            # e.g., 3
         "condenser_mode_string": (str, 1),      # e.g., "PROBE"
-        "convergence_angle": (float, 1),        # e.g., 0.01, in rad (T5984)
-        "beam_blanked": (bool, 1),              # True, False
+        "convergence_angle": (float, 1, None, 0.0, 1e-6), # e.g., 0.01, in rad (T5984)
+        "beam_blanked": (bool, 1, 0.1),         # True, False
         # for meta data key 'electron_gun.voltage'
-        "voltage": (float, 1),                  # e.g., "200"
+        "voltage": (float, 1, 5.0, 1e-3),       # e.g., "200"
         # for backend key 'microscope.elementValues.HTOffset'
         "voltage_offset": (float, 1),           # e.g., "0.1"
         # for meta data key "objective.mode -> projector.camera_length"
-        "indicated_camera_length": (float, 1),  # e.g., "0.028999", in meters
+        "indicated_camera_length": (float, 1, None, 0.0, 1e-6), # e.g., "0.028999", in meters
         # for meta data key "objective.mode -> projector.magnification"
         "indicated_magnification": (float, 1),  # e.g., 200000.0
         # for meta data key "objective.mode -> projector.mode"
@@ -0,0 +1,443 @@
+from __future__ import division, print_function
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ImageSimulator(object):
+    """
+    Generator for synthetic detector images.
+
+    The specimen is a periodic, seeded random texture. The images are sampled from the texture depending on
+    the stage position, the image shift and the pixel size on the specimen (given by the magnification). Defocus
+    blurs the texture (done in Fourier space, the blurred textures are cached). The counts are scaled by the dose
+    (dose rate, exposure time and binning) and shot noise is added. Below :attr:`POISSON_LIMIT` counts, the
+    noise follows the exact Poisson distribution (inverse transform sampling with a lookup table). Above, it is
+    approximated by normal noise. The uniform and normal deviates are taken at random offsets from pregenerated
+    buffers.
+
+        >>> simulator = ImageSimulator(seed=1)
+        >>> image = simulator.acquire((2048, 2048), pixel_size=1e-9, exposure=0.1)
+
+    :param seed: Seed for the specimen texture and the noise
+    :type seed: int
+    :param texture_size: Size of the (square) periodic texture in texels
+    :type texture_size: int
+    :param texel_size: Size of a texel on the specimen in meters
+    :type texel_size: float
+    :param dose_rate: Dose in electrons per (unbinned) pixel and second
+    :type dose_rate: float
+    :param blur_per_defocus: Gaussian blur (sigma, in meters) per meter of defocus
+    :type blur_per_defocus: float
+    """
+    # Number of cached blurred textures
+    BLUR_CACHE_SIZE = 8
+    # Expected counts per pixel, below which exact Poisson noise is used
+    POISSON_LIMIT = 16
+    # Resolution of the Poisson lookup table: cells per count, bins of the uniform deviate
+    POISSON_STEPS = 256
+    POISSON_BINS = 1024
+
+    def __init__(self, seed=0, texture_size=1024, texel_size=0.25e-9, dose_rate=200.0, blur_per_defocus=5e-3):
+        self.texture_size = texture_size
+        self.texel_size = texel_size
+        self.dose_rate = dose_rate
+        self.blur_per_defocus = blur_per_defocus
+        self._rng = np.random.RandomState(seed)
+        self._texture_ft = np.fft.rfft2(self._make_texture())
+        self._blurred = OrderedDict()
+        self._noise = np.zeros(0, dtype=np.float32)
+        self._uniform = np.zeros(0, dtype=np.float32)
+        self._uniform_bins = np.zeros(0, dtype=np.int32)
+        self._poisson_table = None
+
+    def _make_texture(self):
+        """Random texture with 1/f like spectrum, scaled to values in [0.1, 1]"""
+        n = self.texture_size
+        field_ft = np.fft.rfft2(self._rng.standard_normal((n, n)))
+        fy = np.fft.fftfreq(n)[:, np.newaxis]
+        fx = np.fft.rfftfreq(n)[np.newaxis, :]
+        field_ft /= 1.0 + (fx * fx + fy * fy) * (n / 8.0) ** 2
+        field = np.fft.irfft2(field_ft, s=(n, n))
+        field -= field.min()
+        field *= 0.9 / field.max()
+        field += 0.1
+        return field.astype(np.float32)
+
+    def texture(self, defocus=0.0):
+        """
+        Return specimen texture blurred according to `defocus` (in meters).
+
+        The blur is quantized to a quarter texel, the last textures are cached.
+        """
+        sigma = round(abs(defocus) * self.blur_per_defocus / self.texel_size * 4.0) / 4.0
+        try:
+            texture = self._blurred.pop(sigma)
+        except KeyError:
+            n = self.texture_size
+            if sigma > 0:
+                fy = np.fft.fftfreq(n)[:, np.newaxis]
+                fx = np.fft.rfftfreq(n)[np.newaxis, :]
+                kernel = np.exp(-2.0 * (np.pi * sigma) ** 2 * (fx * fx + fy * fy))
+                texture = np.fft.irfft2(self._texture_ft * kernel, s=(n, n)).astype(np.float32)
+            else:
+                texture = np.fft.irfft2(self._texture_ft, s=(n, n)).astype(np.float32)
+            if len(self._blurred) >= self.BLUR_CACHE_SIZE:
+                self._blurred.popitem(last=False)
+        self._blurred[sigma] = texture
+        return texture
+
+    def _normal_noise(self, shape):
+        """Standard normal noise of given shape (view into noise buffer at random offset)"""
+        size = int(np.prod(shape))
+        if self._noise.size < 2 * size:
+            self._noise = self._rng.standard_normal(2 * size).astype(np.float32)
+        offset = self._rng.randint(0, self._noise.size - size + 1)
+        return self._noise[offset:offset + size].reshape(shape)
+
+    def _uniform_noise(self, size):
+        """
+        Uniform deviates in [0, 1) and their bin in the Poisson lookup table
+        (views into noise buffers at random offset)
+        """
+        if self._uniform.size < 2 * size:
+            self._uniform = self._rng.random_sample(2 * size).astype(np.float32)
+            # Rounding to float32 may yield 1.0
+            np.minimum(self._uniform, np.nextafter(np.float32(1.0), np.float32(0.0)), out=self._uniform)
+            self._uniform_bins = (self._uniform * self.POISSON_BINS).astype(np.int32)
+        offset = self._rng.randint(0, self._uniform.size - size + 1)
+        return self._uniform[offset:offset + size], self._uniform_bins[offset:offset + size]
+
+    @staticmethod
+    def _poisson_cdf(lam, max_count):
+        """Poisson CDF for counts 0...max_count (last axis) and the given expected counts"""
+        lam = np.asarray(lam, dtype=np.float64)[..., np.newaxis]
+        pmf = np.empty(lam.shape[:-1] + (max_count + 1,))
+        pmf[..., 0:1] = np.exp(-lam)
+        for k in range(1, max_count + 1):
+            pmf[..., k:k + 1] = pmf[..., k - 1:k] * lam / k
+        return np.cumsum(pmf, axis=-1)
+
+    def poisson_table(self):
+        """
+        Return lookup table for Poisson sampling.
+
+        The expected count is divided into cells of 1 / :attr:`POISSON_STEPS` counts, the uniform deviate into
+        :attr:`POISSON_BINS` bins. An entry holds the sampled count, if it is the same for all expected counts
+        of the cell and all deviates of the bin. Otherwise it is 255.
+        """
+        if self._poisson_table is None:
+            steps, bins = self.POISSON_STEPS, self.POISSON_BINS
+            max_count = min(int(self.POISSON_LIMIT + 10 * np.sqrt(self.POISSON_LIMIT) + 10), 254)
+            cdf = self._poisson_cdf(np.arange(self.POISSON_LIMIT * steps + 1) / steps, max_count)
+            edges = np.arange(bins + 1) / bins
+            table = np.empty((cdf.shape[0] - 1, bins), dtype=np.uint8)
+            for cell in range(table.shape[0]):
+                # The sampled count (number of CDF values below the deviate) increases with the deviate and
+                # the expected count, so the cell is unambiguous if both corners yield the same count
+                lower = np.searchsorted(cdf[cell], edges[:-1])
+                upper = np.searchsorted(cdf[cell + 1], edges[1:])
+                table[cell] = np.where((lower == upper) & (upper <= max_count), lower, 255)
+            self._poisson_table = table
+        return self._poisson_table
+
+    def _poisson_sample(self, lam):
+        """Poisson distributed counts (as float32) for a 1D array of expected counts below POISSON_LIMIT"""
+        u, bins = self._uniform_noise(lam.size)
+        index = (lam * np.float32(self.POISSON_STEPS)).astype(np.int32)
+        index *= self.POISSON_BINS
+        index += bins
+        counts = self.poisson_table().reshape(-1).take(index)
+        ambiguous = np.flatnonzero(counts == 255)
+        counts = counts.astype(np.float32)
+
+        # Ambiguous entries: inverse transform sampling with the exact expected counts
+        if ambiguous.size:
+            sub_lam = lam[ambiguous].astype(np.float64)
+            sub_u = u[ambiguous]
+            p = np.exp(-sub_lam)
+            cdf = p.copy()
+            more = sub_u > cdf
+            k = more.astype(np.float32)
+            count = 0
+            while more.any():
+                count += 1
+                p *= sub_lam / count
+                cdf += p
+                np.greater(sub_u, cdf, out=more)
+                k += more
+            counts[ambiguous] = k
+        return counts
+
+    def acquire(self, shape, pixel_size, exposure, binning=1, position=(0.0, 0.0), image_shift=(0.0, 0.0),
+                defocus=0.0, dtype=np.int16):
+        """
+        Generate image.
+
+        :param shape: Shape (height, width) of the (binned) image
+        :param pixel_size: Size of an unbinned detector pixel on the specimen in meters
+        :param exposure: Exposure time in seconds
+        :param binning: Binning
+        :param position: (x, y) position of the image center on the specimen in meters (stage position)
+        :param image_shift: (x, y) image shift in meters
+        :param defocus: Defocus in meters
+        :param dtype: Type of the returned image (values are clipped to its range)
+        :returns: Image as numpy array
+        """
+        height, width = shape
+        n = self.texture_size
+        texture = self.texture(defocus)
+
+        # Texel coordinates of the sampled pixels (nearest neighbour sampling of the periodic texture)
+        step = pixel_size * binning / self.texel_size
+        center_x = (position[0] + image_shift[0]) / self.texel_size
+        center_y = (position[1] + image_shift[1]) / self.texel_size
+        index_x = (np.floor(center_x + (np.arange(width) - 0.5 * width) * step).astype(np.int64)) % n
+        index_y = (np.floor(center_y + (np.arange(height) - 0.5 * height) * step).astype(np.int64)) % n
+        # Columns first: the row gather only copies whole rows
+        image = np.take(texture, index_x, axis=1)[index_y]
+
+        # Counts and noise
+        dose = self.dose_rate * exposure * binning * binning
+        image *= dose
+        flat = image.reshape(-1)
+        if flat.max() < self.POISSON_LIMIT:
+            flat[:] = self._poisson_sample(flat)
+        elif flat.min() >= self.POISSON_LIMIT:
+            # Normal approximation. The noise buffer is reused, so it must not be modified
+            scale = np.sqrt(image)
+            np.multiply(scale, self._normal_noise(image.shape), out=scale)
+            image += scale
+        else:
+            low = np.flatnonzero(flat < self.POISSON_LIMIT)
+            high = np.flatnonzero(flat >= self.POISSON_LIMIT)
+            flat[low] = self._poisson_sample(flat[low])
+            values = flat[high]
+            values += np.sqrt(values) * self._normal_noise(values.shape)
+            flat[high] = values
+
+        if np.issubdtype(dtype, np.integer):
+            # Round to counts
+            image += 0.5
+            info = np.iinfo(dtype)
+        else:
+            info = np.finfo(dtype)
+        np.clip(image, max(info.min, 0), info.max, out=image)
+        return image.astype(dtype)
+
+
+class FramePool(object):
+    """
+    Bounded pool of precomputed frames.
+
+    The first `frames_per_key` frames requested for a key (e.g. the detector parameters) are generated and kept,
+    afterwards the kept frames are returned in turn. If the total size of the kept frames would exceed
+    `max_bytes`, the frames of the least recently used keys are discarded.
+
+    Recycled frames are read-only, since they are shared between all callers. With `perturb`, each returned frame
+    is a copy of a kept frame, circularly shifted by a random number of pixels, so that consecutive frames differ.
+
+        >>> pool = FramePool(frames_per_key=4)
+        >>> frame = pool.get(("CCD", 1, "FULL"), generate_frame)
+
+    :param frames_per_key: Number of frames kept per key
+    :type frames_per_key: int
+    :param max_bytes: Maximum total size of the kept frames in bytes
+    :type max_bytes: int
+    :param perturb: Whether returned frames are randomly shifted copies of the kept frames
+    :type perturb: bool
+    :param seed: Seed for the perturbation
+    :type seed: int
+    """
+    def __init__(self, frames_per_key=8, max_bytes=256 * 1024 * 1024, perturb=False, seed=0):
+        if frames_per_key < 1:
+            raise ValueError("Pool must keep at least one frame per key.")
+        self.frames_per_key = frames_per_key
+        self.max_bytes = max_bytes
+        self.perturb = perturb
+        self._rng = np.random.RandomState(seed)
+        self._frames = OrderedDict()    # key -> list of frames, in order of last use
+        self._next = {}                 # key -> index of next recycled frame
+        self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        """Total size of the kept frames in bytes"""
+        return self._nbytes
+
+    def clear(self):
+        """Discard all kept frames."""
+        self._frames.clear()
+        self._next.clear()
+        self._nbytes = 0
+
+    def _evict(self, nbytes, keep):
+        """Discard frames of least recently used keys (except `keep`), until `nbytes` more fit into the pool"""
+        while self._nbytes + nbytes > self.max_bytes:
+            key = next((key for key in self._frames if key != keep), None)
+            if key is None:
+                return False
+            self._nbytes -= sum(frame.nbytes for frame in self._frames.pop(key))
+            self._next.pop(key, None)
+        return True
+
+    def get(self, key, generate):
+        """
+        Return frame for `key`.
+
+        :param key: Hashable key of the frame parameters
+        :param generate: Callable without arguments generating a new frame (numpy array) for `key`
+        :returns: numpy array
+        """
+        frames = self._frames.pop(key, [])
+        self._frames[key] = frames
+        if len(frames) < self.frames_per_key and key not in self._next:
+            frame = generate()
+            if self._evict(frame.nbytes, key):
+                frame.flags.writeable = False
+                frames.append(frame)
+                self._nbytes += frame.nbytes
+                return frame.copy() if self.perturb else frame
+            # Pool is full: recycle the frames kept so far
+            if not frames:
+                return frame
+        index = self._next.get(key, 0) % len(frames)
+        self._next[key] = index + 1
+        frame = frames[index]
+        if not self.perturb:
+            return frame
+        flat = frame.reshape(-1)
+        shift = self._rng.randint(0, flat.size)
+        return np.concatenate((flat[shift:], flat[:shift])).reshape(frame.shape)
+
+
+class VirtualClock(object):
+    """
+    Clock for the timing model, optionally running faster than real time.
+
+    :param time_scale: Virtual seconds per real second
+    :type time_scale: float
+    """
+    def __init__(self, time_scale=1.0):
+        if time_scale <= 0:
+            raise ValueError("Time scale must be positive.")
+        self.time_scale = time_scale
+        self._origin = time.time()
+
+    def time(self):
+        """Virtual time in seconds since creation of the clock"""
+        return (time.time() - self._origin) * self.time_scale
+
+    def sleep(self, seconds):
+        """Sleep for `seconds` of virtual time"""
+        if seconds > 0:
+            time.sleep(seconds / self.time_scale)
+
+
+class StageMotion(object):
+    """
+    Linear stage motion from position `start` to `target` during the virtual times `t0` to `t1`.
+
+    :param start: Start position as dict indexed by axis
+    :param target: Target position as dict indexed by axis
+    :param t0: Start time
+    :param t1: End time
+    :param status: Stage status during the motion ("GOING" or "MOVING")
+    """
+    def __init__(self, start, target, t0, t1, status):
+        self.start = dict(start)
+        self.target = dict(target)
+        self.t0 = t0
+        self.t1 = t1
+        self.status = status
+
+    def done(self, now):
+        """Whether the motion has ended at time `now`"""
+        return now >= self.t1
+
+    def position(self, now):
+        """Position at time `now`"""
+        if now >= self.t1:
+            return dict(self.target)
+        fraction = max(0.0, (now - self.t0) / (self.t1 - self.t0))
+        return dict((axis, self.start[axis] + (self.target[axis] - self.start[axis]) * fraction)
+                    for axis in self.start)
+
+
+class TimingModel(object):
+    """
+    Timing of stage moves, lens normalization and detector readout for the :class:`NullMicroscope`.
+
+    Stage moves and normalizations don't block, they are tracked on a :class:`VirtualClock`. Only acquisitions
+    wait (for the end of the lens normalization, the exposure and the readout). With a `time_scale` larger
+    than 1, all of this runs accelerated.
+
+    :param time_scale: Virtual seconds per real second
+    :type time_scale: float
+    :param stage_speed: Stage speed at speed 1.0 for each axis (m/s or rad/s), overrides :attr:`STAGE_SPEED`
+    :type stage_speed: dict
+    :param normalize_times: Normalization time in seconds for each mode, overrides :attr:`NORMALIZE_TIMES`
+    :type normalize_times: dict
+    :param readout_time: Readout time of an unbinned full detector frame in seconds
+    :type readout_time: float
+    """
+    STAGE_SPEED = {'x': 100e-6, 'y': 100e-6, 'z': 20e-6, 'a': 0.1, 'b': 0.1}
+
+    NORMALIZE_TIMES = {
+        "SPOTSIZE": 0.5,
+        "INTENSITY": 0.5,
+        "CONDENSER": 1.0,
+        "MINI_CONDENSER": 0.5,
+        "OBJECTIVE": 1.0,
+        "PROJECTOR": 1.5,
+        "OBJECTIVE_CONDENSER": 2.0,
+        "OBJECTIVE_PROJECTOR": 2.5,
+        "ALL": 3.5,
+    }
+
+    def __init__(self, time_scale=1.0, stage_speed=None, normalize_times=None, readout_time=0.1):
+        self.clock = VirtualClock(time_scale)
+        self.stage_speed = dict(self.STAGE_SPEED)
+        if stage_speed is not None:
+            self.stage_speed.update(stage_speed)
+        self.normalize_times = dict(self.NORMALIZE_TIMES)
+        if normalize_times is not None:
+            self.normalize_times.update(normalize_times)
+        self.readout_time = readout_time
+
+    def _travel_time(self, start, target, axes, speed):
+        return max([abs(target[axis] - start[axis]) / (self.stage_speed[axis] * speed) for axis in axes] + [0.0])
+
+    def move_stage(self, start, target, method="GO", speed=1.0):
+        """
+        Create stage motion starting now.
+
+        With "GO" all axes move simultaneously. With "MOVE" the tilts are zeroed first, then the other axes are
+        moved and finally the tilts are set (the position is still interpolated linearly).
+
+        :param start: Current position as dict indexed by axis
+        :param target: Target position as dict indexed by axis
+        :param method: "GO" or "MOVE"
+        :param speed: Relative speed (1.0 is the default speed)
+        :returns: :class:`StageMotion` instance
+        """
+        if method == "GO":
+            duration = self._travel_time(start, target, start.keys(), speed)
+            status = "GOING"
+        else:
+            zero_tilt = dict(start, a=0.0, b=0.0)
+            duration = (self._travel_time(start, zero_tilt, "ab", speed)
+                        + self._travel_time(start, target, "xyz", speed)
+                        + self._travel_time(zero_tilt, target, "ab", speed))
+            status = "MOVING"
+        now = self.clock.time()
+        return StageMotion(start, target, now, now + duration, status)
+
+    def normalize_duration(self, mode):
+        """Duration of the normalization `mode` in seconds"""
+        return self.normalize_times[mode.upper()]
+
+    def readout_duration(self, pixels, full_pixels):
+        """Readout time in seconds for `pixels` read out of a detector with `full_pixels`"""
+        return self.readout_time * pixels / full_pixels
@@ -0,0 +1,119 @@
+from __future__ import division, print_function
+import struct
+import threading
+import time
+from collections import deque
+
+# Content type of the frame stream (GET /v1/stream): sequence of frames, each consisting of FRAME_HEADER
+# (sequence number and length of message) followed by a message of the binary array transport
+STREAM_CONTENT_TYPE = "application/x-temscript-stream"
+FRAME_HEADER = struct.Struct("<QQ")
+
+
+class FrameStream(object):
+    """
+    Continuous acquisition into a ring buffer.
+
+    The frames are acquired back-to-back on a background thread by calling `acquire` (without arguments).
+    The most recent `buffer_size` frames are kept, older frames are dropped. Each frame gets a sequence
+    number (starting at 1), so consumers can detect dropped frames.
+
+    Several consumers can read the stream independently with :meth:`next_frame`.
+
+    If `executor` is given, `acquire` is called on the executor, so the acquisitions are serialized with
+    the other calls on the executor. Then :meth:`stop` doesn't wait for the current frame (it may be called
+    on the executor itself); no further frame is acquired after it returns.
+
+    :param acquire: Callable returning the images of one frame as dict of numpy arrays indexed by detector name
+    :param n_frames: Number of frames to acquire (default: None, until stopped)
+    :type n_frames: int
+    :param buffer_size: Number of frames kept in the ring buffer
+    :type buffer_size: int
+    :param executor: Executor the acquisitions are run on (default: None, run on the stream thread)
+    :type executor: :class:`temscript.executor.MicroscopeExecutor`
+    """
+    def __init__(self, acquire, n_frames=None, buffer_size=8, executor=None):
+        if buffer_size < 1:
+            raise ValueError("Buffer size must be at least 1.")
+        self._acquire = acquire
+        self._executor = executor
+        self._n_frames = n_frames
+        self._frames = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="FrameStream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while self._running and (self._n_frames is None or self._seq < self._n_frames):
+                if self._executor is not None:
+                    frames = self._executor.call(self._acquire_running)
+                    if frames is None:
+                        break
+                else:
+                    frames = self._acquire()
+                with self._cond:
+                    self._seq += 1
+                    self._frames.append((self._seq, frames))
+                    self._cond.notify_all()
+        except Exception as exc:
+            self._error = exc
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+
+    def _acquire_running(self):
+        # Called on the executor: Skip acquisition, if the stream was stopped meanwhile
+        return self._acquire() if self._running else None
+
+    @property
+    def running(self):
+        """Whether frames are still acquired"""
+        return self._running
+
+    @property
+    def seq(self):
+        """Sequence number of the most recent frame (0: no frame yet)"""
+        return self._seq
+
+    def stop(self, wait=True):
+        """Stop acquisition after the current frame. Already buffered frames can still be read."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if wait and self._executor is None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def next_frame(self, seq=0, timeout=None):
+        """
+        Return oldest buffered frame with a sequence number larger than `seq`.
+
+        Waits for the next frame, if there is no such frame in the buffer.
+
+        :param seq: Sequence number of the last frame read by the consumer (0: start with oldest buffered frame)
+        :param timeout: Timeout in seconds (default: None, wait until the next frame is acquired)
+        :returns: Tuple (sequence number, dict of images) or None if the stream has ended or the timeout expired
+        :raises: The exception raised by the acquisition, if the stream ended due to an error
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                for item in self._frames:
+                    if item[0] > seq:
+                        return item
+                if not self._running:
+                    if self._error is not None:
+                        raise self._error
+                    return None
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)